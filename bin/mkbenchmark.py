@@ -0,0 +1,143 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Benchmark app: time the analysis steps against their reference
+   (pure python) implementation on the data files.
+"""
+
+import os
+import glob
+import time
+import numpy as np
+
+from advlab import ADVLAB_DATA
+from advlab.utils.logging_ import logger, startmsg, abort
+from advlab.utils import gParsing
+from advlab.utils import gAnalysisUtils
+
+__description__ = 'Benchmark the analysis steps'
+
+
+def parse_data_reference(file_path):
+    """Line-by-line parsing of the CAEN ascii file, as originally done
+       by gParsing.parse_data.
+    """
+    lines = open(file_path, 'rb').readlines()
+    return gParsing._parse_lines(lines[0:-1])
+
+def double_coinc_reference(_t1, _t2, _e1, _e2, time_window, tick=1):
+    """Coincidence search looping over the events of the first channel
+       and masking the whole second channel each time, as originally
+       done by gAnalysisUtils.check_double_coinc.
+    """
+    switch = False
+    if len(_t1) > len(_t2):
+        switch = True
+        _t1, _t2, _e1, _e2 = _t2, _t1, _e2, _e1
+    coinc_events = []
+    half_window = (time_window/2)/float(tick)
+    for j, t_min in enumerate(_t1):
+        t_min = t_min - half_window
+        t_max = t_min + half_window
+        _mask = (_t2 >= t_min)*(_t2 <= t_max)
+        for index in np.flatnonzero(_mask):
+            if switch == False:
+                coinc_events.append((_t1[j], _e1[j], _t2[index], _e2[index]))
+            else:
+                coinc_events.append((_t2[index], _e2[index], _t1[j], _e1[j]))
+    t1, e1, t2, e2 = [np.array(item) for item in zip(*coinc_events)] or \
+                     [np.array([])]*4
+    return t1*tick, e1, t2*tick, e2
+
+def same_output(out1, out2):
+    """Compare two tuples of numpy arrays.
+    """
+    if len(out1) != len(out2):
+        return False
+    return all(np.array_equal(a, b) for a, b in zip(out1, out2))
+
+def _file_args(file_path):
+    return (file_path,)
+
+def _coinc_args(file_path):
+    ev0, ev2 = gParsing.process_events(file_path, [0,2])
+    return ev0['t'], ev2['t'], ev0['e'], ev2['e'], 20, gParsing.TICK_NS
+
+"""Available benchmarks: target -> (setup, function, reference function).
+   The setup function takes the path of a data file and returns the
+   arguments of the two functions, which are timed.
+"""
+BENCHMARKS = {
+    'parsing' : (_file_args, gParsing.parse_data, parse_data_reference),
+    'coincidence' : (_coinc_args, gAnalysisUtils.double_coinc,
+                     double_coinc_reference),
+}
+
+DEFAULT_INFILES = [os.path.join(ADVLAB_DATA, 'run_gr2_20160630_coinc_0.dat')]+\
+                  sorted(glob.glob(os.path.join(ADVLAB_DATA, 'scan_*.dat')))
+
+
+"""Command-line switches.
+"""
+import argparse
+
+formatter = argparse.ArgumentDefaultsHelpFormatter
+PARSER = argparse.ArgumentParser(description=__description__,
+                                 formatter_class=formatter)
+PARSER.add_argument('--target', type=str, nargs='+',
+                    default=sorted(BENCHMARKS.keys()),
+                    help='the steps to benchmark')
+PARSER.add_argument('--infiles', type=str, nargs='+', default=DEFAULT_INFILES,
+                    help='the input data files')
+PARSER.add_argument('--repeat', type=int, default=1,
+                    help='number of repetitions (the best time is kept)')
+
+def best_time(function, args, repeat):
+    """Return the output of function(*args) and the best elapsed time
+       over repeat calls.
+    """
+    elapsed = []
+    for i in range(repeat):
+        start = time.time()
+        out = function(*args)
+        elapsed.append(time.time() - start)
+    return out, min(elapsed)
+
+def mkbenchmark(**kwargs):
+    """Run the benchmarks and print the speedup with respect to the
+       reference implementation.
+    """
+    for target in kwargs['target']:
+        if target not in BENCHMARKS:
+            abort('Unknown benchmark %s (choose among %s)' %\
+                  (target, ', '.join(sorted(BENCHMARKS.keys()))))
+        setup, function, reference = BENCHMARKS[target]
+        tot_new, tot_ref = 0., 0.
+        for f in kwargs['infiles']:
+            args = setup(f)
+            out_new, t_new = best_time(function, args, kwargs['repeat'])
+            out_ref, t_ref = best_time(reference, args, kwargs['repeat'])
+            if not same_output(out_new, out_ref):
+                logger.error('%s: output differs from reference for %s' %\
+                             (target, f))
+            logger.info('%s %s: %.4f s (reference %.4f s)' %\
+                        (target, os.path.basename(f), t_new, t_ref))
+            tot_new += t_new
+            tot_ref += t_ref
+        logger.info('%s: total %.3f s, reference %.3f s, speedup x%.1f' %\
+                    (target, tot_new, tot_ref, tot_ref/max(tot_new, 1e-9)))
+
+
+if __name__ == '__main__':
+    args = PARSER.parse_args()
+    startmsg()
+    mkbenchmark(**args.__dict__)
@@ -17,15 +17,15 @@ import ROOT
 import numpy
 import imp
 
-from advlab import ADVLAB_OUT, ADVLAB_DATA
+from advlab import ADVLAB_OUT
 from advlab.utils.logging_ import logger, startmsg
-from advlab.utils.gParsing import process_data
-from advlab.utils.gParsing import parse_coinc_data
+from advlab.utils.gParsing import process_events, TICK_NS
 from advlab.utils.gAnalysisUtils import build_spectrum
 from advlab.utils.gAnalysisUtils import build_spectrum_plt
 from advlab.utils.gAnalysisUtils import build_coinc_curve
 from advlab.utils.gAnalysisUtils import build_coinc_curve_plt
-from advlab.utils.gAnalysisUtils import check_double_coinc
+from advlab.utils.gCoincidence import get_double_coinc
+from advlab.utils.gHistogram import spectrum_accumulator
 from advlab.utils.gRootUtils import gRootCanvas
 from advlab.utils.gRootUtils import gRootLegend
 from advlab.utils.matplotlib_ import pyplot as plt
@@ -69,21 +69,25 @@ def mkcalibration(**kwargs):
     num_en_ch = data.TOT_NUM_EN_CH
     nbins = data.NBINS
     time_window = data.COINC_WINDOW
-    ch, t, e = process_data(infile, [0,2])
-    coinc_file_name = os.path.basename(infile.replace('.dat', \
-                                                      '_COINC.dat'))
-    coinc_file = os.path.join(ADVLAB_DATA, coinc_file_name)
-    logger.info('created %s'%coinc_file)
-    check_double_coinc(t[0], t[1], e[0], e[1], time_window, coinc_file)
-    t1, e1, t2, e2 = parse_coinc_data(coinc_file)
+    # The two channels of the spectra and of the scatter plot.
+    channels = getattr(data, 'CHANNELS', [0, 2])
+    assert(len(channels) == 2)
+    ev0, ev2 = process_events(infile, channels)
+    t1, e1, t2, e2 = get_double_coinc(infile, channels, time_window, \
+                                      events=[ev0, ev2])
+    spec0 = spectrum_accumulator('%s_ch0'%label, num_en_ch, nbins)
+    spec2 = spectrum_accumulator('%s_ch2'%label, num_en_ch, nbins)
+    scatter = spectrum_accumulator('%s_scatter'%label, num_en_ch, nbins, 2)
+    spec0.add(ev0['e'])
+    spec2.add(ev2['e'])
+    scatter.add((e1, e2))
     #-------------Draw Spectra---------------- 
     if AnalyseSpectra == True:
         logger.info('Analyzing Spectrum for %s source...'%label)
         plt.figure(figsize=(10, 7), dpi=80)
         plt.title('%s Spectrum Ch2'%label)
         plt.xlabel('channel')
-        build_spectrum_plt(e[1], bins=nbins, label='chanel 1', color='red', \
-                           alpha=1, range=(0,num_en_ch))
+        build_spectrum_plt(spec2, label='chanel 1', color='red', alpha=1)
         plt.xlim(0,num_en_ch)
         overlay_tag()
         plt_figure = '%s_spectrum_ch2.png'%label
@@ -92,8 +96,7 @@ def mkcalibration(**kwargs):
         plt.figure(figsize=(10, 7), dpi=80)
         plt.title('%s Spectrum Ch0'%label)
         plt.xlabel('channel')
-        build_spectrum_plt(e[0], bins=nbins, range=(0,num_en_ch),\
-                           label='chanel 2', color='blue', alpha=1.)
+        build_spectrum_plt(spec0, label='chanel 2', color='blue', alpha=1.)
         plt.xlim(0, num_en_ch)
         overlay_tag()
         plt_figure = '%s_spectrum_ch0.png'%label
@@ -107,7 +110,7 @@ def mkcalibration(**kwargs):
         plt.ylabel('Ch 2')
         plt.xlim(0, num_en_ch)
         plt.ylim(0, num_en_ch)
-        plt.hist2d(e1, e2, bins=nbins, range=[(0,num_en_ch),(0,num_en_ch)])#, norm=LogNorm())
+        scatter.plot()#, norm=LogNorm())
         plt.colorbar()
         overlay_tag()
         plt_figure = '%s_spectrum_ch0-ch2.png'%label
@@ -119,7 +122,8 @@ def mkcalibration(**kwargs):
         plt.figure(figsize=(10, 8), dpi=80)
         plt.title('Ch0 - Ch2 Coincidence Curve')
         plt.xlabel('time [ns]')
-        h, _diff = build_coinc_curve_plt(t[0], t[1], nbins=2000, label='chanel 2', \
+        h, _diff = build_coinc_curve_plt(ev0['t'], ev2['t'], tick=TICK_NS, \
+                                         nbins=2000, label='chanel 2', \
                                          color='blue', alpha=1.)
         plt.xlim(-10,10)
         plt.yscale('log')
@@ -135,19 +139,17 @@ def mkcalibration(**kwargs):
     if RootAnalyseSpectra == True or RootAnalyseCoincidence == True:
         f = ROOT.TFile(root_outfile, 'RECREATE')
     if RootAnalyseSpectra == True:
-        h1 = build_spectrum('%s_channel_0'%label, e[0], num_en_ch)  
-        h2 = build_spectrum('%s_channel_1'%label, e[1], num_en_ch)
+        h1 = build_spectrum('%s_channel_0'%label, ev0['e'], num_en_ch)  
+        h2 = build_spectrum('%s_channel_1'%label, ev2['e'], num_en_ch)
         # should there be the check of the coincidence here
-        hh = ROOT.TH2F('%s_scatter'%label,'%s'%label, nbins, 0, num_en_ch, \
-                       nbins, 0, num_en_ch)
-        for i,e0 in enumerate(e1):
-            hh.Fill(e1[i], e2[i])
+        scatter.title = label
+        hh = scatter.to_root()
         h1.Write()
         h2.Write()
         hh.Write()
 
     if RootAnalyseCoincidence == True:
-        h = build_coinc_curve(t[0], t[1])
+        h = build_coinc_curve(ev0['t'], ev2['t'], tick=TICK_NS)
         h.SetTitle('Coincidence Curve')
         h.GetXaxis().SetTitle('Time delay [ns]')
         h.GetYaxis().SetTitle('counts')
@@ -0,0 +1,128 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Energy calibration app: find the photopeaks of the calibration sources
+   in the spectra of each channel and fit a new calibration table.
+
+   The table is written in ADVLAB_OUT, to be checked, unless --install
+   is given (the existing tables in config/calibration are never
+   overwritten).
+"""
+
+import os
+import time
+import imp
+import multiprocessing
+
+from advlab import ADVLAB_CONFIG, ADVLAB_OUT
+from advlab.utils.logging_ import logger, startmsg, abort
+from advlab.utils.gAnalysisUtils import accumulate_spectra
+from advlab.utils.gCalibration import SOURCE_LINES, find_photopeaks
+from advlab.utils.gCalibration import fit_calibration, save_calibration
+from advlab.utils.gCalibration import calib_file
+
+__description__ = 'Fit the energy calibration to the source runs'
+
+# Full range of the 14 bit ADC.
+ADC_RANGE = 16384
+
+DEFAULT_CONFIGS = [os.path.join(ADVLAB_CONFIG, \
+                                'calibration_analysis_%s.py' % src) \
+                   for src in sorted(SOURCE_LINES.keys())]
+
+
+"""Command-line switches.
+"""
+import argparse
+
+formatter = argparse.ArgumentDefaultsHelpFormatter
+PARSER = argparse.ArgumentParser(description=__description__,
+                                 formatter_class=formatter)
+PARSER.add_argument('--configfiles', type=str, nargs='+',
+                    default=DEFAULT_CONFIGS,
+                    help='the configuration files of the source runs')
+PARSER.add_argument('--channels', type=int, nargs='+', default=[0, 2],
+                    help='the channels to calibrate')
+PARSER.add_argument('--nbins', type=int, default=2048,
+                    help='number of bins of the spectra (over the ADC range)')
+PARSER.add_argument('--version', type=str,
+                    default=time.strftime('auto_%Y%m%d'),
+                    help='name of the new calibration table')
+PARSER.add_argument('--install', action='store_true', default=False,
+                    help='write the new table in config/calibration '
+                    '(instead of ADVLAB_OUT)')
+PARSER.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                    help='number of parallel processes')
+
+def source_peaks(args):
+    """Return the source and the positions of its photopeaks in each
+       channel (or None if the run is not available).
+    """
+    config_file, channels, nbins = args
+    if not os.path.exists(config_file):
+        logger.warning('Skipping %s (file not found)' % config_file)
+        return config_file, None
+    data = imp.load_source('data_%d' % os.getpid(), config_file)
+    lines = SOURCE_LINES.get(data.SRC)
+    if lines is None or not os.path.exists(data.DATA_FILE):
+        logger.warning('Skipping %s (unknown source or missing data file)' %\
+                       config_file)
+        return data.SRC, None
+    spectra = accumulate_spectra(data.DATA_FILE, channels, ADC_RANGE, nbins)
+    peaks = [find_photopeaks(h.centers(), h.values(), len(lines)) \
+             for h in spectra]
+    return data.SRC, peaks
+
+def mkenergycalib(**kwargs):
+    """Process the source runs in parallel, match the peaks found in each
+       channel to the known lines (in increasing order) and fit all of them
+       together.
+    """
+    channels = kwargs['channels']
+    jobs = [(f, channels, kwargs['nbins']) for f in kwargs['configfiles']]
+    pool = multiprocessing.Pool(max(1, min(kwargs['jobs'], len(jobs))))
+    results = pool.map(source_peaks, jobs)
+    pool.close()
+    pool.join()
+    points = dict((ch, []) for ch in channels)
+    sources = []
+    for src, peaks in results:
+        if peaks is None:
+            continue
+        sources.append(src)
+        for ch, _peaks in zip(channels, peaks):
+            if _peaks is None:
+                logger.warning('%s: peaks not found in channel %i' % (src, ch))
+                continue
+            for adc, en in zip(_peaks, sorted(SOURCE_LINES[src])):
+                logger.info('%s, ch%i: peak at channel %.1f -> line at '\
+                            '%.3f MeV' % (src, ch, adc, en))
+                points[ch].append((round(float(adc), 1), en))
+    try:
+        calib = fit_calibration(kwargs['version'], points, \
+                                'Photopeaks of %s' % ', '.join(sources))
+    except ValueError as e:
+        abort(str(e))
+    if kwargs['install']:
+        if os.path.exists(calib_file(calib.version)):
+            abort('%s already exists, choose another --version' %\
+                  calib_file(calib.version))
+        save_calibration(calib)
+    else:
+        save_calibration(calib, ADVLAB_OUT)
+    return calib
+
+
+if __name__ == '__main__':
+    args = PARSER.parse_args()
+    startmsg()
+    mkenergycalib(**args.__dict__)
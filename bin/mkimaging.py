@@ -15,9 +15,9 @@
 
 import os
 import numpy as np
-import ROOT
 import re
 import imp
+import multiprocessing
 
 from advlab import ADVLAB_DATA
 from advlab import ADVLAB_OUT
@@ -39,6 +39,17 @@ PARSER = argparse.ArgumentParser(description=__description__,
                                  formatter_class=formatter)
 PARSER.add_argument('--configfile', type=str, required=True,
                     help='the input configuration file')
+PARSER.add_argument('--checkpoint', action='store_true', default=False,
+                    help='write the histograms of the scans in ADVLAB_OUT')
+PARSER.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                    help='number of parallel processes over the scan files')
+PARSER.add_argument('--method', type=str, default='backprojection',
+                    choices=['backprojection', 'mlem'],
+                    help='the reconstruction of the image')
+PARSER.add_argument('--iterations', type=int, default=20,
+                    help='maximum number of MLEM iterations')
+PARSER.add_argument('--subsets', type=int, default=1,
+                    help='number of ordered subsets (OSEM) of the lines')
 
 def get_var_from_file(filename):
     f = open(filename)
@@ -67,22 +78,33 @@ def mkimaging(**kwargs):
     all_th = np.unique(thet_list)
     yref_list = np.array(yref_list)
     lines_list, coinc_list = [], []
-    from advlab.utils.gBox import build_rate_hist
-    os.system('rm %s'%os.path.join(ADVLAB_OUT,'y_scan.root'))
+    from advlab.utils.gBox import build_rate_hists
     from advlab.utils.gBox import mkline
-    for th in all_th:
-        logger.info('List of angles scanned:')
-        _index = np.where(thet_list == th)
-        _y, _coinc = build_rate_hist('th%i'%th, infiles[_index], \
-                                     yref_list[_index])
+    hist_list = []
+    logger.info('List of angles scanned: %s'%all_th)
+    for th, _y, _coinc, h in build_rate_hists(thet_list, infiles, yref_list, \
+                                              jobs=kwargs['jobs']):
+        hist_list.append(h)
         coinc_list.extend(_coinc)
         for y in _y:
             lines_list.append(mkline(y, th))
+    if kwargs['checkpoint'] == True:
+        from advlab.utils.gBox import save_scan_hists
+        save_scan_hists(hist_list)
 
-    from advlab.utils.gBox import imaging 
     outfile_name = data.OUTFILE
     gran = data.GRAN
-    imaging(lines_list, coinc_list, sidex, sidey, gran=gran, outfile=outfile_name)
+    if kwargs['method'] == 'mlem':
+        from advlab.utils.gReconstruction import reconstruct
+        reconstruct(lines_list, coinc_list, sidex, sidey, gran=gran, \
+                    num_iter=kwargs['iterations'], subsets=kwargs['subsets'], \
+                    outfile=outfile_name)
+        return
+    from advlab.utils.gBox import imaging 
+    kernel = getattr(data, 'KERNEL', 'box')
+    sigma = getattr(data, 'KERNEL_SIGMA', None)
+    imaging(lines_list, coinc_list, sidex, sidey, gran=gran, outfile=outfile_name,
+            kernel=kernel, sigma=sigma)
     
 if __name__ == '__main__':
     args = PARSER.parse_args()
@@ -15,9 +15,9 @@
 
 import os
 import numpy as np
-import ROOT
 import re
 import imp
+import multiprocessing
 from scipy import signal
 
 from advlab import ADVLAB_DATA
@@ -41,6 +41,10 @@ PARSER = argparse.ArgumentParser(description=__description__,
                                  formatter_class=formatter)
 PARSER.add_argument('--configfile', type=str, required=True,
                     help='the input configuration file')
+PARSER.add_argument('--checkpoint', action='store_true', default=False,
+                    help='write the histograms of the scans in ADVLAB_OUT')
+PARSER.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                    help='number of parallel processes over the scan files')
 
 def get_var_from_file(filename):
     f = open(filename)
@@ -70,17 +74,17 @@ def mkkalmanfilter(**kwargs):
     all_th = np.unique(thet_list)
     yref_list = np.array(yref_list)
     th_list, y_list = [], []
-    from advlab.utils.gBox import build_rate_hist
-    os.system('rm %s'%os.path.join(ADVLAB_OUT,'y_scan.root'))
+    from advlab.utils.gBox import build_rate_hists
     from advlab.utils.gAnalysisUtils import find_peaks
-    for th in all_th:
-        logger.info('List of angles scanned:')
-        _index = np.where(thet_list == th)
-        _y, _coinc = build_rate_hist('th%i'%th, infiles[_index], \
-                                     yref_list[_index])
+    logger.info('List of angles scanned: %s'%all_th)
+    hist_list = [h for th, _y, _coinc, h in \
+                 build_rate_hists(thet_list, infiles, yref_list, \
+                                  jobs=kwargs['jobs'])]
+    if kwargs['checkpoint'] == True:
+        from advlab.utils.gBox import save_scan_hists
+        save_scan_hists(hist_list)
     from advlab.utils.gAnalysisUtils import find_peaks_fit
-    th_list, y_list, sigy_list = find_peaks_fit(os.path.join(ADVLAB_OUT,\
-                                                             'y_scan.root'))
+    th_list, y_list, sigy_list = find_peaks_fit(hist_list)
     from advlab.utils.gBox import get_combinations
     th_comb_list, y_comb_list, sigy_comb_list = get_combinations(th_list, \
                                                                  y_list, \
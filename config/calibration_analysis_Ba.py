@@ -27,3 +27,5 @@ TOT_NUM_EN_CH = 3000
 NBINS = 100
 DATA_FILE = os.path.join(ADVLAB_DATA, 'run_gr2_20160704_Ba.dat')
 COINC_WINDOW = 20
+# Channels of the two detectors in coincidence.
+CHANNELS = [0, 2]
@@ -27,4 +27,6 @@ TOT_NUM_EN_CH = 8000
 NBINS = 100
 DATA_FILE = os.path.join(ADVLAB_DATA, 'run_gr2_20160704_Co.dat')
 COINC_WINDOW = 20
+# Channels of the two detectors in coincidence.
+CHANNELS = [0, 2]
 
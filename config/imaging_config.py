@@ -13,7 +13,6 @@
 """Imaging Configuration file
 """
 
-import ROOT
 import os
 import numpy as np
 
@@ -22,6 +21,10 @@ from advlab import ADVLAB_DATA
 SIDEX = 80
 SIDEY = 55
 GRAN = 10
+# Point-spread kernel of the image: 'box', 'gaus' (with KERNEL_SIGMA [mm])
+# or 'geometry' (see gBox.psf_kernel).
+KERNEL = 'box'
+KERNEL_SIGMA = 2.
 OUTFILE = 'redbox_imaging.root'
 KF_OUTFILE = 'KF_vertexing.png'
 
@@ -0,0 +1,48 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Unit tests for the energy calibration.
+"""
+
+import unittest
+
+from advlab.utils.gCalibration import load_calibration, fit_calibration
+
+
+class TestFitCalibration(unittest.TestCase):
+
+    def setUp(self):
+        self.points = load_calibration('gr2_20160630').points
+
+    def test_good_fit(self):
+        """The points of the reference table pass the quality checks.
+        """
+        calib = fit_calibration('test', self.points)
+        self.assertEqual(calib.channels(), [0, 2])
+
+    def test_wrong_peak(self):
+        """A Compton edge (0.477 MeV for Cs) matched to the photopeak is
+           rejected.
+        """
+        points = dict((ch, list(_points)) for ch, _points in \
+                      self.points.items())
+        points[0] = [(adc*0.477/0.662, en) if en == 0.662 else (adc, en) \
+                     for adc, en in points[0]]
+        self.assertRaises(ValueError, fit_calibration, 'test', points)
+
+    def test_too_few_points(self):
+        self.assertRaises(ValueError, fit_calibration, 'test', \
+                          {0: [(100, 0.03)]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Unit tests for the coincidence engine.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from advlab import ADVLAB_DATA
+from advlab.utils.gAnalysisUtils import find_double_coinc, double_coinc
+from advlab.utils.gAnalysisUtils import check_double_coinc
+from advlab.utils.gParsing import process_events, parse_coinc_data
+from advlab.utils.gParsing import EVENT_DTYPE, TICK_NS
+from advlab.utils.gCoincidence import find_multi_coinc, iter_double_coinc
+from advlab.utils.gCoincidence import stream_double_coinc
+
+
+def _random_times(num, t_max, seed):
+    np.random.seed(seed)
+    return np.sort(np.random.randint(0, t_max, num)).astype(np.int64)
+
+
+class TestMultiCoinc(unittest.TestCase):
+
+    def test_anchored_two_fold(self):
+        """With a reference channel, the 2-fold coincidences are exactly the
+           pairs of find_double_coinc (in the same order).
+        """
+        t1 = _random_times(2000, 100000, 1)
+        t2 = _random_times(3000, 100000, 2)
+        for window, tick in ((20, 4), (7, 1), (10, 1)):
+            i1, i2 = find_double_coinc(t1, t2, window, tick)
+            table = find_multi_coinc([t1, t2], window, 2, tick, ref=0)
+            self.assertTrue(np.array_equal(table[:, 0], i1))
+            self.assertTrue(np.array_equal(table[:, 1], i2))
+            i2, i1 = find_double_coinc(t2, t1, window, tick)
+            table = find_multi_coinc([t1, t2], window, 2, tick, ref=1)
+            self.assertTrue(np.array_equal(table[:, 0], i1))
+            self.assertTrue(np.array_equal(table[:, 1], i2))
+
+    def test_first_event_two_fold(self):
+        """Anchored to the first event, the 2-fold coincidences of isolated
+           pairs are those of find_double_coinc in either order.
+        """
+        np.random.seed(3)
+        t1 = np.arange(100, 100000, 100, dtype=np.int64)
+        t2 = t1 + np.random.randint(-15, 16, len(t1))
+        window = 20
+        table = find_multi_coinc([t1, t2], window, 2)
+        pairs = set(zip(*find_double_coinc(t1, t2, window))) | \
+                set((i1, i2) for i2, i1 in zip(*find_double_coinc(t2, t1, \
+                                                                  window)))
+        self.assertEqual(set(map(tuple, table)), pairs)
+        self.assertTrue(np.all(np.abs(t1[table[:, 0]] - t2[table[:, 1]]) <= \
+                               window/2))
+
+    def test_no_chaining(self):
+        """Events following each other within the window do not make a
+           group longer than the window.
+        """
+        t_list = [np.array([0]), np.array([8]), np.array([16])]
+        table = find_multi_coinc(t_list, 20, 2)
+        self.assertEqual(table.tolist(), [[0, 0, -1]])
+        self.assertEqual(len(find_multi_coinc(t_list, 20, 3)), 0)
+        self.assertEqual(len(find_multi_coinc(t_list, 32, 3)), 1)
+
+    def test_repeated_hits(self):
+        """All the events of a channel in the same window are returned.
+        """
+        t_list = [np.array([0, 5]), np.array([8]), np.array([100])]
+        table = find_multi_coinc(t_list, 20, 2)
+        self.assertEqual(table.tolist(), [[0, 0, -1], [1, 0, -1]])
+        table = find_multi_coinc(t_list[:2], 20, 2, ref=1)
+        self.assertEqual(table.tolist(), [[0, 0], [1, 0]])
+
+    def test_empty(self):
+        t_list = [np.array([], dtype=np.int64), np.array([3])]
+        self.assertEqual(find_multi_coinc(t_list, 20, 2).shape, (0, 2))
+        self.assertEqual(find_multi_coinc(t_list, 20, 2, ref=0).shape, (0, 2))
+
+
+def _events(t, e):
+    events = np.zeros(len(t), dtype=EVENT_DTYPE)
+    events['t'], events['e'] = t, e
+    return events
+
+def _concatenate(coinc_list):
+    return [np.concatenate(column) for column in zip(*coinc_list)]
+
+
+class TestStreamDoubleCoinc(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_files(self):
+        """The streamed coincidences are those of check_double_coinc, for
+           any chunk size.
+        """
+        for file_name in ('run_gr2_20160630_coinc_0.dat', 'scan_0_40.dat'):
+            file_path = os.path.join(ADVLAB_DATA, file_name)
+            ev1, ev2 = process_events(file_path, [0, 2], use_cache=False)
+            outfile = os.path.join(self.folder, file_name)
+            check_double_coinc(ev1['t'], ev2['t'], ev1['e'], ev2['e'], 20, \
+                               outfile, TICK_NS)
+            ref = parse_coinc_data(outfile)
+            for chunk_size in (1000, 7777, 100000):
+                coinc = _concatenate(stream_double_coinc(file_path, [0, 2], \
+                                                         20, chunk_size))
+                for column, ref_column in zip(coinc, ref):
+                    self.assertTrue(np.array_equal(column, ref_column))
+
+    def test_chunk_boundary(self):
+        """The pairs across the boundary of two chunks are found once,
+           thanks to the events kept from the previous chunk.
+        """
+        t1 = _random_times(2000, 20000, 4)
+        t2 = _random_times(3000, 20000, 5)
+        e1, e2 = np.arange(len(t1)), 1000 + np.arange(len(t2))
+        window, tick = 20, 2
+        bounds = [0] + list(range(37, 20000, 211)) + [20000]
+        chunks = []
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            _m1, _m2 = (t1 >= low) & (t1 < high), (t2 >= low) & (t2 < high)
+            chunks.append((_events(t1[_m1], e1[_m1]), \
+                           _events(t2[_m2], e2[_m2])))
+        for swap in (False, True):
+            ref = double_coinc(t1, t2, e1, e2, window, tick, swap)
+            coinc = _concatenate(iter_double_coinc(chunks, window, tick, swap))
+            for column, ref_column in zip(coinc, ref):
+                self.assertTrue(np.array_equal(column, ref_column))
+            # Some of the pairs do cross a boundary.
+            _cut = np.searchsorted(bounds, ref[0]/tick, side='right') != \
+                   np.searchsorted(bounds, ref[2]/tick, side='right')
+            self.assertTrue(np.any(_cut))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Unit tests for the parsing of the data files.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from advlab.utils.gParsing import write_coinc_data, parse_coinc_data, \
+     make_selection, select_events, EVENT_DTYPE
+from advlab.utils.gParsing import _parse_block, _parse_lines
+from advlab.utils.gAnalysisUtils import check_double_coinc
+
+
+class TestParseBlock(unittest.TestCase):
+
+    LINES = [b'0 1000 512 0 0', b'2 1003 77 0 0', b'1 1010 4000 0 0']
+
+    def assertSameParsing(self, text):
+        """The vectorized parser gives the same arrays as the line-by-line
+           one.
+        """
+        for column, ref_column in zip(_parse_block(text), \
+                                      _parse_lines(text.split(b'\n'))):
+            self.assertEqual(column.tolist(), ref_column.tolist())
+
+    def test_good(self):
+        self.assertSameParsing(b'\n'.join(self.LINES) + b'\n')
+        self.assertEqual(_parse_block(b'\n'.join(self.LINES) + b'\n')[1]\
+                         .tolist(), [1000, 1003, 1010])
+
+    def test_wrong_columns(self):
+        for line in (b'3 1020 55 0', b'3 1020 55 0 0 0', b'', b'   '):
+            self.assertSameParsing(b'\n'.join(self.LINES[:2] + [line] + \
+                                              self.LINES[2:]) + b'\n')
+
+    def test_not_numbers(self):
+        for line in (b'3 1020 abc 0 0', b'# 1020 55 0 0', b'3 1020 5.5 0 0',
+                     b'3 1e3 55 0 0'):
+            self.assertSameParsing(b'\n'.join(self.LINES[:2] + [line] + \
+                                              self.LINES[2:]) + b'\n')
+
+    def test_crlf(self):
+        self.assertSameParsing(b'\r\n'.join(self.LINES) + b'\r\n')
+        self.assertEqual(len(_parse_block(b'\r\n'.join(self.LINES) + \
+                                          b'\r\n')[0]), 3)
+
+    def test_no_final_newline(self):
+        self.assertSameParsing(b'\n'.join(self.LINES))
+        self.assertSameParsing(b'\n'.join(self.LINES) + b'\n3 10')
+
+
+class TestCoincData(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.columns = (np.array([10, 250, 4000]), np.array([1.5, 20., 3.25]),
+                        np.array([0, 240, 3990]), np.array([7., 8.5, 9.]))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_ascii(self):
+        """The legacy ASCII format is written on request.
+        """
+        file_path = os.path.join(self.folder, 'run_COINC.dat')
+        write_coinc_data(file_path, *self.columns, text=True)
+        lines = open(file_path).read().split('\n')
+        self.assertTrue(lines[0].startswith('#FIRST CHANNEL'))
+        self.assertEqual(lines[4], '10 1.50 0 7.00')
+        for column, parsed in zip(self.columns, parse_coinc_data(file_path)):
+            self.assertTrue(np.allclose(column, parsed))
+
+    def test_ascii_malformed(self):
+        """The malformed lines of the ASCII files are skipped.
+        """
+        file_path = os.path.join(self.folder, 'run_COINC.dat')
+        open(file_path, 'w').write('#time - energy\n\n10 1.50 0 7.00\n'
+                                   '20 2.5 11\nfoo 1 2 3\n30 3.5 21 4.5')
+        t1, e1, t2, e2 = parse_coinc_data(file_path)
+        self.assertEqual(list(t1), [10, 30])
+        self.assertEqual(list(e2), [7., 4.5])
+
+    def test_binary(self):
+        """The default format holds the records of the coincidence store,
+           whatever the extension of the file.
+        """
+        file_path = os.path.join(self.folder, 'run_COINC.dat')
+        write_coinc_data(file_path, *self.columns)
+        coinc = np.load(file_path)
+        self.assertEqual(coinc.dtype.names, ('t1', 'e1', 't2', 'e2'))
+        for column, parsed in zip(self.columns, parse_coinc_data(file_path)):
+            self.assertTrue(np.allclose(column, parsed))
+
+    def test_check_double_coinc(self):
+        """check_double_coinc writes the binary format by default.
+        """
+        t1, e1, t2, e2 = self.columns
+        for text in (False, True):
+            file_path = os.path.join(self.folder, 'run_%s.dat' % text)
+            check_double_coinc(t1, t2, e1, e2, 20, file_path, text=text)
+            self.assertEqual(open(file_path, 'rb').read(1) == b'#', text)
+            parsed = parse_coinc_data(file_path)
+            self.assertEqual(list(parsed[0]), [10, 250, 4000])
+            self.assertEqual(list(parsed[2]), [0, 240, 3990])
+
+
+class TestSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.events = np.zeros(6, dtype=EVENT_DTYPE)
+        self.events['ch'] = [0, 2, 5, -1, -2, 3]
+        self.events['t'] = np.arange(6)
+        self.events['e'] = [100, 200, 300, 400, 500, 600]
+
+    def test_out_of_range(self):
+        """The events of the channels outside the table are dropped, and
+           the negative ones do not wrap around to the last channels.
+        """
+        selection = make_selection([0, 2, 3])
+        self.assertEqual(list(select_events(self.events, selection)['t']),
+                         [0, 1, 5])
+
+    def test_large_channel(self):
+        """The table grows with the channels of the selection.
+        """
+        accept = np.zeros(65536, dtype=bool)
+        accept[300] = True
+        selection = make_selection([0, 5], {5: accept})
+        self.assertEqual(selection.shape[0], 6)
+        self.assertEqual(list(select_events(self.events, selection)['t']),
+                         [0, 2])
+
+    def test_negative_channel(self):
+        self.assertRaises(ValueError, make_selection, [0, -1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Unit tests of the MLEM/OSEM reconstruction.
+"""
+
+import unittest
+import numpy as np
+
+from advlab.utils.gBox import mkline, image_binning
+from advlab.utils.gReconstruction import system_matrix, mlem
+
+
+class TestMlem(unittest.TestCase):
+
+    def setUp(self):
+        """Two point sources over a flat background, seen by lines at 0,
+           40 and 80 degrees.
+        """
+        sources = [(-10., 5.), (15., -8.)]
+        lines_list, rate_list = [], []
+        for th in (0, 40, 80):
+            for y in np.arange(-30, 31, 2.5):
+                line = mkline(y, th)
+                (x1, y1), (x2, y2) = line
+                dist = [abs((y2 - y1)*sx - (x2 - x1)*sy + x2*y1 - y2*x1)/\
+                        np.hypot(x2 - x1, y2 - y1) for sx, sy in sources]
+                lines_list.append(line)
+                rate_list.append(1 + sum(100*np.exp(-0.5*(d/2.)**2) \
+                                         for d in dist))
+        self.matrix = system_matrix(lines_list, image_binning(80, 55))
+        self.counts = np.array(rate_list)
+
+    def test_mlem(self):
+        """A single subset is the plain MLEM.
+        """
+        a = self.matrix.toarray()
+        sens = a.sum(axis=0)
+        image = (sens > 0).astype(np.float64)
+        for i in range(10):
+            proj = a.dot(image)
+            ratio = np.where(proj > 0, self.counts/np.where(proj > 0, proj, 1),
+                             0)
+            image *= np.where(sens > 0,
+                              a.T.dot(ratio)/np.where(sens > 0, sens, 1), 0)
+        osem, times = mlem(self.matrix, self.counts, 10, 1, tolerance=0)
+        self.assertEqual(len(times), 10)
+        self.assertTrue(np.allclose(osem, image, rtol=1e-10))
+
+    def test_support(self):
+        """The ordered subsets do not erase the pixels that a subset does
+           not see.
+        """
+        image = mlem(self.matrix, self.counts, 10, 1)[0]
+        for subsets in (2, 3, 7):
+            osem = mlem(self.matrix, self.counts, 10, subsets)[0]
+            self.assertTrue(np.array_equal(osem > 0, image > 0))
+
+    def test_subsets(self):
+        """At most one subset per line.
+        """
+        num_lines = self.matrix.shape[0]
+        image = mlem(self.matrix, self.counts, 3, num_lines)[0]
+        osem = mlem(self.matrix, self.counts, 3, num_lines + 5)[0]
+        self.assertTrue(np.array_equal(osem, image))
+        self.assertRaises(ValueError, mlem, self.matrix, self.counts, 3, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
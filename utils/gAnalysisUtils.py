@@ -12,13 +12,18 @@
 
 import numpy as np
 import os
-import ROOT
-from ROOT import *
 
 from advlab import ADVLAB_OUT
 from advlab.utils.logging_ import logger
 from advlab.utils.matplotlib_ import pyplot as plt
 from advlab.utils.matplotlib_ import save_current_figure, overlay_tag
+from advlab.utils.gParsing import write_coinc_data, iter_events
+from advlab.utils.gParsing import DEFAULT_CHUNK_SIZE
+from advlab.utils.gHistogram import histogram1d, root_hist1d
+from advlab.utils.gHistogram import gHistogram, load_histograms
+from advlab.utils.gHistogram import spectrum_accumulator
+from advlab.utils.gCalibration import load_calibration, DEFAULT_CALIB_VERSION
+from advlab.utils.gFitting import double_gaus, fit_double_gaus_batch
 
 def find_peaks(th, _x, _y, threashold):
     """to be finished
@@ -35,110 +40,216 @@ def find_peaks(th, _x, _y, threashold):
     save_current_figure('th%i_peaks.png'%th, clear=False)
     return _x[c]
 
-def find_peaks_fit(file_name, isfit=True):
+def find_two_peaks(content_list):
+    """Return, for each histogram of a list, the bin indices (in the
+       contents including the underflow and overflow bins) of its two
+       highest local maxima, in increasing order.
+
+       All the histograms are processed at once: the contents are stacked
+       (padded with -inf), the local maxima (bins higher than both their
+       neighbours, from bin 1 to nbins - 1) are found with array
+       comparisons, and the two highest of each row are taken (the first
+       one on ties). A single maximum is returned twice, and the highest
+       bin is used if there are none.
+
+       Arguments
+       ---------
+       content_list : list of numpy arrays
+           contents of the histograms, with underflow and overflow
     """
+    size = max(len(c) for c in content_list)
+    content = np.full((len(content_list), size), -np.inf)
+    for i, c in enumerate(content_list):
+        content[i, :len(c)] = c
+    nbins = np.array([len(c) - 2 for c in content_list])
+    _index = np.arange(size)
+    is_max = np.zeros(content.shape, dtype=bool)
+    is_max[:, 1:-1] = (content[:, :-2] < content[:, 1:-1]) & \
+                      (content[:, 1:-1] > content[:, 2:])
+    is_max &= (_index >= 1) & (_index[None, :] <= nbins[:, None] - 1)
+    score = np.where(is_max, content, -np.inf)
+    top = np.argsort(-score, axis=1, kind='mergesort')[:, :2]
+    num_max = is_max.sum(axis=1)
+    top[num_max == 1, 1] = top[num_max == 1, 0]
+    in_range = (_index >= 1) & (_index[None, :] <= nbins[:, None])
+    highest = np.argmax(np.where(in_range, content, -np.inf), axis=1)
+    top[num_max == 0] = highest[num_max == 0, None]
+    return np.sort(top, axis=1)
+
+def find_peaks_fit(hist_source, isfit=True, jobs=1):
+    """Find the two peaks of the number of coincidences as a function of
+       the position y for each scanning angle, and fit them with a double
+       gaussian (all the angles at once, see gFitting).
+
+       Arguments
+       ---------
+       hist_source : str or list of gHistogram
+           the histograms (named th<angle>) built by gBox.build_rate_hist,
+           or the path of the .npz, HDF5 or ROOT file where they are
+       isfit : bool
+           if False, only the position of the peaks is returned
+       jobs : int
+           number of processes sharing the fits
     """
-    file1 = ROOT.TFile(file_name)
-    y_list  = []
-    sigy_list = []
-    th_list = []
-    for key in file1.GetListOfKeys():
-        th_list.append((int(key.GetName().replace("th","")), \
-                       int(key.GetName().replace("th",""))))
-        h = file1.Get(key.GetName())
-        peaks = []
-        for i in range(1, h.GetNbinsX()):
-            if h.GetBinContent(i-1) < h.GetBinContent(i) and  \
-               h.GetBinContent(i) > h.GetBinContent(i+1):
-                peaks.append((h.GetBinCenter(i), h.GetBinContent(i)))
-            if len(peaks) > 2:
-                if peaks[0][1] < peaks[1][1] and peaks[0][1] < peaks[2][1]: 
-                    peaks.pop(0)
-                elif peaks[1][1] < peaks[0][1] and peaks[1][1] < peaks[2][1]: 
-                    peaks.pop(1)
-                elif peaks[2][1] < peaks[0][1] and peaks[2][1] < peaks[1][1]: 
-                    peaks.pop(2)
-        if len(peaks) == 1: 
-            peaks.append(peaks[0])
-        if not isfit:
-            y_list.append((peaks[0], peaks[1]))
-            continue
-        Max = h.GetXaxis().GetXmax()
-        Min = h.GetXaxis().GetXmin()
-        g1 = ROOT.TF1("g1", "gaus", Min, Max)
-        g2 = ROOT.TF1("g2","gaus", Min, Max)
-        g1.SetParameter(1, peaks[0][0])
-        g1.SetParameter(2, 6)
-        g2.SetParameter(1, peaks[1][0])
-        g2.SetParameter(2, 6)
-        ftot = ROOT.TF1( 'total', 'gaus(0)+gaus(3)', Min, Max )
-        par11, par12, par13 = g1.GetParameter(0), g1.GetParameter(1), \
-                              g1.GetParameter(2)
-        par21, par22, par23 = g2.GetParameter(0),  g2.GetParameter(1),  \
-                              g2.GetParameter(2)
-        par = np.array([par11, par12, par13, par21, par22, par23])
-        ftot.SetParameters(par)
-        h.Fit(ftot)
-        y_list.append((ftot.GetParameter(1), ftot.GetParameter(4)))
-        sigy_list.append((ftot.GetParError(1)/\
-                          np.sqrt(ftot.Eval(ftot.GetParameter(1))), \
-                          ftot.GetParError(4)/\
-                          np.sqrt(ftot.Eval(ftot.GetParameter(4)))))
-        
+    if isinstance(hist_source, str):
+        hist_source = load_histograms(hist_source)
+    th_list = [(int(h.name.replace("th","")),)*2 for h in hist_source]
+    if len(hist_source) == 0:
+        return th_list, [], []
+    x_list = [h.centers() for h in hist_source]
+    top = find_two_peaks([h.content for h in hist_source])
+    peaks = [[(x[i - 1], h.content[i]) for i in _top] \
+             for x, h, _top in zip(x_list, hist_source, top)]
+    if not isfit:
+        return th_list, [tuple(_peaks) for _peaks in peaks], []
+    p0_list = [[p1[1], p1[0], 6, p2[1], p2[0], 6] for p1, p2 in peaks]
+    par, err = fit_double_gaus_batch(x_list, [h.values() for h in hist_source],\
+                                     p0_list, jobs)
+    y_list = [(p[1], p[4]) for p in par]
+    sigy_list = [(e[1]/np.sqrt(double_gaus(p[1], *p)), \
+                  e[4]/np.sqrt(double_gaus(p[4], *p))) for p, e in zip(par, err)]
     return th_list, y_list, sigy_list
 
-def build_spectrum(name, _e, tot_num_en_ch):
+def build_spectrum(name, _e, tot_num_en_ch, as_root=True):
     """Returns a root THF1 with the energy spectrum of the gamma 
-       emission from a ginven src
+       emission from a ginven src (or a gHistogram if as_root is False)
     """
-    nbins = tot_num_en_ch/2
-    h = ROOT.TH1F(name, name, nbins, 0, tot_num_en_ch)
-    for en in _e:
-        h.Fill(en)
+    nbins = int(tot_num_en_ch/2)
+    h = gHistogram(name, name, [(nbins, 0, tot_num_en_ch)])
+    h.fill(_e)
+    if as_root:
+        return h.to_root()
     return h
 
 def build_spectrum_plt(_e, **kwargs):
     """Returns a histo (using matplotlib) with the energy spectrum of the gamma 
        emission from a ginven src
+
+       _e can also be an already filled gHistogram, which is drawn as it is
+       (the bins and range keyword arguments are then ignored).
     """
+    if isinstance(_e, gHistogram):
+        return _e.plot(label=kwargs['label'], color=kwargs['color'], \
+                       alpha=kwargs['alpha'])
     h = plt.hist(_e, bins=kwargs['bins'], label=kwargs['label'], \
                  color=kwargs['color'], alpha=kwargs['alpha'],\
                  range=kwargs['range'] )
     return h
     
-def channel2energy(_e, ch_num):
+def accumulate_spectra(file_path, num_of_channels, tot_num_en_ch, nbins, \
+                       chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return the energy spectra (gHistogram) of the given channels of a
+       data file, reading it in chunks of events.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the data file
+       num_of_channels : list of int
+           the channels (0, 1, 2, or 3)
+       tot_num_en_ch : int
+           upper edge of the spectra
+       nbins : int
+           number of bins of the spectra
+       chunk_size : int
+           number of events read at a time
+    """
+    spectra = [spectrum_accumulator('channel_%i' % ch, tot_num_en_ch, nbins) \
+               for ch in num_of_channels]
+    for chunk in iter_events(file_path, chunk_size):
+        for ch, spectrum in zip(num_of_channels, spectra):
+            spectrum.add(chunk['e'][chunk['ch'] == ch])
+    return spectra
+
+def channel2energy(_e, ch_num, version=DEFAULT_CALIB_VERSION):
     """Calibrate the measure of energy in the channels
 
+       The linear calibration of each channel is taken from the registry of
+       gCalibration (fitted only once per session).
+
        Arguments
        ---------
-       _e : numpy array of floats
+       _e : numpy array
            Array where all the energy channels are stored for each event
-       tot_num_en_ch : int
-           number of storing channels 
-       ref_point1, ref_point2 : each one is a couples of numbers 
-           e.g. (ch_ref1,e_ref1),(ch_ref2,e_ref2)
-           It is assumed that for each couple the first num is the channel
-           while the sencond is the corresponding energy [given in MeV].
+       ch_num : int
+           the channel (0 or 2 in the default calibration)
+       version : str
+           the version of the calibration table
     """
-    ch, en = [], [] 
-    calib_ch0 = [(1917,0.356),(466,0.03),(2721,0.511),(6594,1.27),\
-                 (3504,0.662),(6044,1.17),(6843,1.33)]
-    calib_ch2 = [(2022,0.356),(496,0.03),(2846,0.511),(6906,1.27),\
-                 (3674,0.662),(6362,1.17),(7214,1.33)]
-    if ch_num == 0:
-        ch.append([x[0] for x in calib_ch0])
-        en.append([x[1] for x in calib_ch0])
-    if ch_num == 2:
-        ch.append([x[0] for x in calib_ch2])
-        en.append([x[1] for x in calib_ch2])
-    ch = np.array(ch[0])
-    en = np.array(en[0])
-    p = np.polyfit(ch, en, 1)
-    logger.info('Energy fit parameters: [0]=%f, [1]=%f'%(p[0], p[1]))
-    en_array = p[1] + _e*p[0]
-    return en_array
+    return load_calibration(version).to_energy(_e, ch_num)
+
+def find_double_coinc(_t1, _t2, time_window, tick=1):
+    """Return the indices (i1, i2) of the pairs of events in coincidence,
+       i.e. such that _t1[i1] - time_window/2 <= _t2[i2] <= _t1[i1].
 
-def check_double_coinc(_t1, _t2, _e1, _e2, time_window, outfile):
+       The pairs are sorted by i1 and then by i2. Instead of scanning _t2
+       for each event of _t1, the range of matching events is found with
+       a binary search in the time-ordered _t2, so that the cost is
+       O(N log M) instead of O(N*M).
+
+       Arguments
+       ---------
+       _t1 : numpy array of int
+           array of a first chanel event arrival times
+       _t2 : numpy array of int
+           array of a second chanel event arrival times
+       time_window : float
+           coincidence window
+       tick : int
+           unit of _t1 and _t2 in terms of the unit of time_window
+    """
+    half_window = (time_window/2)/float(tick)
+    _order = None
+    if not np.all(_t2[1:] >= _t2[:-1]):
+        _order = np.argsort(_t2, kind='mergesort')
+        _t2 = _t2[_order]
+    t_min = _t1 - half_window
+    if np.issubdtype(_t2.dtype, np.integer):
+        t_min = np.ceil(t_min).astype(_t2.dtype)
+    _low = np.searchsorted(_t2, t_min, side='left')
+    _high = np.searchsorted(_t2, _t1, side='right')
+    _num = np.clip(_high - _low, 0, None)
+    i1 = np.repeat(np.arange(len(_t1)), _num)
+    i2 = np.arange(_num.sum()) - np.repeat(np.cumsum(_num) - _num - _low, _num)
+    if _order is not None:
+        i2 = _order[i2]
+        _index = np.lexsort((i2, i1))
+        i1, i2 = i1[_index], i2[_index]
+    return i1, i2
+
+def double_coinc(_t1, _t2, _e1, _e2, time_window, tick=1, swap=None):
+    """Return the times and energies (t1, e1, t2, e2) of the pairs of
+       events in coincidence, as written by check_double_coinc.
+
+       The window is taken before each event of the channel with fewer
+       events (see find_double_coinc); the pairs are ordered as these
+       events, and the times are returned in the unit of time_window.
+
+       Arguments
+       ---------
+       _t1, _t2 : numpy arrays of int
+           arrays of the first and second chanel event arrival times
+       _e1, _e2 : numpy arrays
+           arrays of the first and second chanel event energies
+       time_window : float
+           coincidence window
+       tick : int
+           unit of _t1 and _t2 in terms of the unit of time_window
+       swap : bool
+           whether the window is taken before the events of the second
+           channel; if None, if the second channel has fewer events
+    """
+    if swap is None:
+        swap = len(_t1) > len(_t2)
+    if swap:
+        logger.info('Exchanging time arrays to maintain the sequence...')
+        i2, i1 = find_double_coinc(_t2, _t1, time_window, tick)
+    else:
+        i1, i2 = find_double_coinc(_t1, _t2, time_window, tick)
+    return _t1[i1]*tick, _e1[i1], _t2[i2]*tick, _e2[i2]
+
+def check_double_coinc(_t1, _t2, _e1, _e2, time_window, outfile, tick=1, \
+                       text=False):
     """Check events happened in coincidence, inside a coincidence window,
        
        Arguments
@@ -151,49 +262,64 @@ def check_double_coinc(_t1, _t2, _e1, _e2, time_window, outfile):
            coincidence window in us
        outfile : str
            output file name
+       tick : int
+           unit of _t1 and _t2 in terms of the unit of time_window (e.g.
+           gParsing.TICK_NS for the time stamps of the CAEN events);
+           the times are written in the output file in the latter unit
+       text : bool
+           if True, write the legacy ASCII format instead of the binary
+           one (see gParsing.write_coinc_data)
     """
     if os.path.exists(outfile):
         logger.info('Already created %s'%outfile)
         return 0
     logger.info('Scanning the data to find coincidences...')
-    switch = False
-    if len(_t1) > len(_t2):
-        switch = True
-        logger.info('Exchanging time arrays to maintain the sequence...')
-        _ttemp =  _t1
-        _t1 = _t2
-        _t2 = _ttemp
-        _etemp =  _e1
-        _e1 = _e2
-        _e2 = _etemp
-    coinc_events = []
-    for j, t_min in enumerate(_t1):
-        t_min = t_min - time_window/2
-        t_max = t_min + time_window/2
-        _mask = (_t2 >= t_min)*(_t2 <= t_max)
-        if np.count_nonzero(_mask) != 0:
-            for i, item in enumerate(_t2[_mask]):
-                index = np.where(_t2 == _t2[_mask][i])[0]
-                if len(index)>1:
-                    index = [np.amin(abs(index-t1))]
-                if switch == False:
-                    coinc_events.append((_t1[j], _e1[j], _t2[index], \
-                                         _e2[index]))
-                else:
-                    coinc_events.append((_t2[index], _e2[index], _t1[j], \
-                                         _e1[j]))
-    logger.info('%i pairs of coincident events found!'%len(coinc_events))
-    file_to_write = open(outfile, 'w')
-    file_to_write.write('#FIRST CHANNEL\t#SECOND CHANNEL \n\n')
-    file_to_write.write('#time - energy\t#time -  energy \n\n')
-    for line in coinc_events:
-        file_to_write.write('%i %.2f %i %.2f\n' %(line[0], line[1], line[2],\
-                                                   line[3]))
-    file_to_write.close()
+    t1, e1, t2, e2 = double_coinc(_t1, _t2, _e1, _e2, time_window, tick)
+    logger.info('%i pairs of coincident events found!'%len(t1))
+    write_coinc_data(outfile, t1, e1, t2, e2, text)
     logger.info('Created output file %s...'%outfile)
     return 0
 
-def build_coinc_curve(_t1, _t2):
+def nearest_delays(_t1, _t2, max_delay=1000, tick=1):
+    """Return the delays t1 - t2 between each event of the channel with
+       fewer events and the closest event (in time) of the other one,
+       keeping only those shorter than max_delay.
+
+       The closest event is found with a binary search in the
+       time-ordered array of the second channel, comparing the two
+       neighbours of each event of the first one.
+
+       Arguments
+       ---------
+       _t1 : numpy array of int
+           array of a first chanel event arrival times (ordered)
+       _t2 : numpy array of int
+           array of a second chanel event arrival times (ordered)
+       max_delay : float
+           maximum absolute delay, in the unit of the output
+       tick : int
+           unit of _t1 and _t2 in terms of the unit of the output
+    """
+    if len(_t1) > len(_t2):
+        logger.info('Excenging time arrays to maintain the sequence...')
+        _t1, _t2 = _t2, _t1
+    diff_eff = abs(len(_t1)-len(_t2))
+    tot_evt = max(len(_t1),len(_t2))
+    logger.info('Difference of number of events: %i/%i' \
+                %(diff_eff,tot_evt))
+    if len(_t2) == 0:
+        return np.array([], dtype=np.float64)
+    _right = np.clip(np.searchsorted(_t2, _t1), 1, len(_t2) - 1)
+    _left = _right - 1
+    if len(_t2) == 1:
+        _right = _left = np.zeros(len(_t1), dtype=np.int64)
+    _diff_left = _t1 - _t2[_left]
+    _diff_right = _t1 - _t2[_right]
+    _diff = np.where(abs(_diff_left) <= abs(_diff_right), _diff_left, \
+                     _diff_right)*tick
+    return _diff[abs(_diff) < max_delay]
+
+def build_coinc_curve(_t1, _t2, tick=1):
     """Returns the histogram to estrapolate the coincidence curve
 
        Arguments        
@@ -202,43 +328,16 @@ def build_coinc_curve(_t1, _t2):
            array of a first chanel event arrival times in us 
        _t2 : numpy array of int [times in us]      
            array of a second chanel event arrival times in us  
+       tick : int
+           unit of _t1 and _t2 in ns
     """
-    # _t1 and _t2 are ordered arrays
-    # Check which array starts first
-    if len(_t1) > len(_t2):
-        logger.info('Excenging time arrays to maintain the sequence...')
-        _ttemp =  _t1
-        _t1 = _t2
-        _t2 = _ttemp
-    diff_eff = abs(len(_t1)-len(_t2))
-    tot_evt = max(len(_t1),len(_t2))
-    logger.info('Difference of number of events: %i/%i' \
-                %(diff_eff,tot_evt))
     logger.info('Building Coincidence Curve...')
-    h2 = ROOT.TH1F('delay2', 'delay2', 200, -100.5, 99.5)
-    # Loop over the shorter array
-    for i,t1 in enumerate(_t1):
-        # Loop over the second array but from the (i-3)th element
-        # for this reason, skip the first 3 entries
-        if i < 3:
-            pass
-        else:
-            min_diff = 100000000000.
-            for t2 in _t2[i-3:]:
-                # Check when there is the minimum distance and record it
-                # exit the inner loop when distance start to increase
-                abs_diff = abs(t1-t2)
-                if abs_diff > min_diff:
-                    break
-                else:
-                    min_diff = t1-t2
-                    continue
-            if abs(min_diff) < 1000:
-                h2.Fill(min_diff)
-    return h2   
+    _diff = nearest_delays(_t1, _t2, tick=tick)
+    counts = histogram1d(_diff, 200, -100.5, 99.5)
+    return root_hist1d('delay2', 'delay2', counts, -100.5, 99.5, len(_diff))   
 
    
-def build_coinc_curve_plt(_t1,_t2, **kwargs):
+def build_coinc_curve_plt(_t1,_t2, tick=1, **kwargs):
     """Returns a histo (using matplotlib) with the energy spectrum of the gamma 
        emission from a ginven src
        
@@ -248,40 +347,11 @@ def build_coinc_curve_plt(_t1,_t2, **kwargs):
            array of a first chanel event arrival times in us 
        _t2 : numpy array of int [times in us]      
            array of a second chanel event arrival times in us  
+       tick : int
+           unit of _t1 and _t2 in ns
     """
-    # _t1 and _t2 are ordered arrays
-    # Check which array starts first
-    if len(_t1) > len(_t2):
-        logger.info('Excenging time arrays to maintain the sequence...')
-        _ttemp =  _t1
-        _t1 = _t2
-        _t2 = _ttemp
-    diff_eff = abs(len(_t1)-len(_t2))
-    tot_evt = max(len(_t1),len(_t2))
-    logger.info('Difference of number of events: %i/%i' \
-                %(diff_eff,tot_evt))
     logger.info('Building Coincidence Curve...')
-    _diff = []
-    # Loop over the shorter array
-    for i,t1 in enumerate(_t1):
-        # Loop over the second array but from the ith element
-        # for this reason, skip the first 3 entries
-        if i < 3:
-            pass
-        else:
-            min_diff = 100000000000.
-            for t2 in _t2[i-3:]:
-                # Check when there is the minimum distance and record it
-                # exit the inner loop when distance start to increase
-                abs_diff = abs(t1-t2)
-                if abs_diff > min_diff:
-                    break
-                else:
-                    min_diff = t1-t2
-                    continue
-            if abs(min_diff) < 1000:
-                _diff.append(min_diff)
-    _diff = np.array(_diff)
+    _diff = nearest_delays(_t1, _t2, tick=tick)
     nbins = kwargs['nbins']
     h = plt.hist(_diff, nbins, label=kwargs['label'], color=kwargs['color'],\
                  alpha=kwargs['alpha'], align='mid')
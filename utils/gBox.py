@@ -14,26 +14,46 @@
 
 import os
 import math
+import multiprocessing
 import numpy as np
-import ROOT
 from scipy.interpolate import griddata
 
 from advlab import ADVLAB_OUT
-from advlab import ADVLAB_DATA
 from advlab.utils.matplotlib_ import pyplot as plt
 from advlab.utils.matplotlib_ import overlay_tag, save_current_figure
 from advlab.utils.logging_ import logger
-from advlab.utils.gAnalysisUtils import check_double_coinc
-from advlab.utils.gAnalysisUtils import channel2energy
-from advlab.utils.gParsing import process_data
-from advlab.utils.gParsing import parse_coinc_data
+from advlab.utils.gCalibration import energy_selection
+from advlab.utils.gParsing import process_events, TICK_NS
+from advlab.utils.gCoincidence import get_double_coinc
+from advlab.utils.gHistogram import gHistogram, bin_index, save_histograms
 
 # Coordinates of the mobile RS in the Lab RS.
 MOB_RS_Y = 150 #mm
 MOB_RS_X = 0
 
+# File (in ADVLAB_OUT) with the histograms of the scans at each angle.
+SCAN_FILE_NAME = 'y_scan.npz'
+
+# Energy window [MeV] of the events of the coincidences used for imaging.
+ENERGY_WINDOW = (0.1, 1.)
+
+# Channels of the detectors of the scans.
+COINC_CHANNELS = [0, 2]
+
+# Half width of the face of the detectors and distance between them [mm].
+DET_HALF_WIDTH = 10.23
+DET_DISTANCE = 128.
+
+# Point-spread kernels available for the smearing of the image.
+PSF_KERNELS = ['box', 'gaus', 'geometry']
+
 def get_m_q(line):
-    m = (line[1][1]-line[0][1])/(line[1][0]-line[0][0])
+    """Return the slope and the intercept of a line; for a vertical line
+       the slope is inf and the intercept is replaced by the x of the line.
+    """
+    if line[1][0] == line[0][0]:
+        return np.inf, line[0][0]
+    m = (line[1][1]-line[0][1])/float(line[1][0]-line[0][0])
     q = line[0][1]-m*line[0][0]
     return m, q
 
@@ -80,13 +100,18 @@ def get_combinations(th_list, y_list, sigy_list, num_scan_angles):
 def build_states(th_list, y_list, sigy_list, return_lines=False):
     """
     """
-    a, b = 10.23, 128.
+    a, b = DET_HALF_WIDTH, DET_DISTANCE
     state_list, cov_list, lines = [], [], []
     for i, th in enumerate(th_list):
         line = mkline(y_list[i], th)
         m, q = get_m_q(line)
         yref = 26.5
-        if m != 0:
+        if np.isinf(m):
+            uk = 0.
+            xk = q
+            sig_uu = 2*a/b
+            sig_xx = np.sqrt(sig_uu**2 + sigy_list[i]**2)
+        elif m != 0:
             uk = 1./m
             xk = uk*(yref - q)
             sig_uu = 2*a/b
@@ -106,99 +131,281 @@ def build_states(th_list, y_list, sigy_list, return_lines=False):
     #plt.show()
     return state_list, cov_list
 
+def image_binning(x_side, y_side, gran=1):
+    """Return the binning of the image of the box, (nbins, min, max) for
+       each axis, with 2*gran bins every 5 mm.
+    """
+    return [(int(x_side//5)*2*gran, -x_side/2., x_side/2.), \
+            (int(y_side//5)*2*gran, -y_side/2., y_side/2.)]
+
+def lines_pixels(lines_list, binning):
+    """Return the pixels (flattened in C order, x major) crossed by a set
+       of lines inside the image, and the length of the lines in each of
+       them, as three flat arrays: the index of the line, the pixel and
+       the length (sorted by line).
+
+       Each line is cut at all its crossings with the edges of the bins
+       (Siddon's method), so that each piece lies in a single pixel; the
+       crossings of all the lines are computed and sorted at once, as a 2d
+       array with one row per line.
+
+       Arguments
+       ---------
+       lines_list : list
+           the lines, ((x1, y1), (x2, y2))
+       binning : list of tuples
+           (nbins, min, max) for the x and y axes of the image
+    """
+    (nx, xmin, xmax), (ny, ymin, ymax) = binning
+    p = np.array(lines_list, dtype=np.float64).reshape((len(lines_list), 4))
+    x1, y1 = p[:, 0, None], p[:, 1, None]
+    dx, dy = p[:, 2, None] - x1, p[:, 3, None] - y1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = np.hstack([np.zeros((len(p), 1)), np.ones((len(p), 1)),
+                           (np.linspace(xmin, xmax, nx + 1) - x1)/dx,
+                           (np.linspace(ymin, ymax, ny + 1) - y1)/dy])
+        # The crossings outside the lines (or missing, for the lines
+        # parallel to an axis) become pieces of null length at the end.
+        alpha[~((alpha >= 0) & (alpha <= 1))] = 1
+    alpha.sort(axis=1)
+    mid = 0.5*(alpha[:, 1:] + alpha[:, :-1])
+    x, y = x1 + mid*dx, y1 + mid*dy
+    length = np.diff(alpha, axis=1)*np.hypot(dx, dy)
+    _mask = (length > 0) & (x >= xmin) & (x < xmax) & (y >= ymin) & \
+            (y < ymax)
+    rows = np.nonzero(_mask)[0]
+    pixels = (bin_index(x[_mask], nx, xmin, xmax) - 1)*ny + \
+             bin_index(y[_mask], ny, ymin, ymax) - 1
+    return rows, pixels, length[_mask]
+
+def psf_kernel(kernel, bin_width, gran=1, sigma=None):
+    """Return the offsets (in bins) and the values of a 1d point-spread
+       kernel, applied along each axis of the image.
+
+       For backward compatibility the kernels are not normalized to 1:
+       all of them have the total weight of the legacy box, i.e. 2*gran
+       along each axis, so that the scale of the image does not depend
+       on the kernel.
+
+       Arguments
+       ---------
+       kernel : str
+           'box': weight 1 from -gran to gran - 1 (the legacy smearing);
+           'gaus': gaussian with the given sigma [mm];
+           'geometry': response of a pair of detectors at half distance,
+           i.e. a triangle with FWHM = DET_HALF_WIDTH
+       bin_width : float
+           width of the bins [mm]
+       gran : int
+           half size of the box, in bins
+       sigma : float
+           sigma of the gaussian [mm]
+    """
+    if kernel == 'box':
+        offsets = np.arange(-gran, gran)
+        return offsets, np.ones(len(offsets))
+    if kernel == 'gaus':
+        if sigma is None:
+            raise ValueError('The gaussian kernel needs a sigma')
+        _sig = sigma/bin_width
+        half = int(np.ceil(3*_sig))
+        offsets = np.arange(-half, half + 1)
+        values = np.exp(-0.5*(offsets/_sig)**2)
+    elif kernel == 'geometry':
+        half = int(np.ceil(DET_HALF_WIDTH/bin_width))
+        offsets = np.arange(-half, half + 1)
+        values = np.maximum(0, 1 - np.abs(offsets)*bin_width/DET_HALF_WIDTH)
+    else:
+        raise ValueError('Unknown kernel %s (choose among %s)' %\
+                         (kernel, ', '.join(PSF_KERNELS)))
+    return offsets, 2.*gran*values/values.sum()
+
+def _smear_matrix(nbins, offsets, values):
+    """Return the matrix (over the bins of an axis, including the underflow
+       and the overflow) spreading the content of each bin b over the bins
+       b + offsets with the kernel values, skipping the bin numbers <= 0
+       and setting the ones beyond the overflow to the overflow (as ROOT).
+    """
+    src = np.repeat(np.arange(nbins + 2), len(offsets))
+    dst = src + np.tile(offsets, nbins + 2)
+    w = np.tile(values, nbins + 2)
+    _mask = dst > 0
+    src, dst, w = src[_mask], np.minimum(dst[_mask], nbins + 1), w[_mask]
+    return np.bincount(dst*(nbins + 2) + src, weights=w, \
+                       minlength=(nbins + 2)**2)\
+             .reshape((nbins + 2, nbins + 2))
+
 def imaging(lines_list, rate_list, x_side, y_side, gran=1, \
-            outfile='imaging.root'):
+            outfile='imaging.root', kernel='box', sigma=None):
     """perform the imaging of the gamma-ray emission from sources 
        inside the red box
+
+       The lines are back-projected all at once, each pixel crossed by a
+       line getting the weight of the line times the length of the line
+       in the pixel, in units of the width of the x bins (see
+       lines_pixels), and the point-spread kernel is applied once to the
+       whole image, as a separable convolution: the product of the
+       smearing matrices of the two axes (see psf_kernel). With the 'box'
+       kernel each pixel also keeps its own content, as in the legacy
+       (2*gran)x(2*gran) smearing.
+
+       The image is written in outfile, as a ROOT file or in the format
+       given by its extension (see gHistogram.save_histograms).
     """
-    f = ROOT.TFile(os.path.join(ADVLAB_OUT,outfile), 'RECREATE')
-    xh_low, xh_high = -x_side/2., x_side/2.
-    yh_low, yh_high = -y_side/2., y_side/2.
-    xh_bins = np.linspace(xh_low, xh_high, (x_side/5)*2*gran)
-    yh_bins = np.linspace(yh_low, yh_high, (y_side/5)*2*gran)
-    xh_nbins = len(xh_bins)
-    yh_nbins = len(yh_bins)
-    hh = ROOT.TH2F('pet', 'Sources imaging', xh_nbins, xh_low, xh_high, \
-                   yh_nbins, yh_low, yh_high)
-    hh.GetXaxis().SetTitle('x [mm]')
-    hh.GetYaxis().SetTitle('y [mm]')
-    for i in range(-xh_nbins/2, xh_nbins/2):
-        for j in range(-yh_nbins/2, yh_nbins/2):
-            hh.Fill(i,j,1)
-    for i,line in enumerate(lines_list):
-        m, q = get_m_q(line)
-        _x = xh_bins
-        _y = _x*m + q
-        _mask = (_y<=yh_high)&(_y>=yh_low)
-        _x = _x[_mask]
-        _y = _y[_mask]
-        w = rate_list[i]
-        for i, x in enumerate(_x):
-            bx = hh.GetXaxis().FindBin(x)
-            by = hh.GetYaxis().FindBin(_y[i])
-            new_w = hh.GetBinContent(bx,by)+w
-            hh.SetBinContent(bx,by,new_w)
-            for zx in range(bx-gran, bx+gran):
-                if zx == 0 or zx < 0:
-                    continue
-                for zy in range(by-gran, by+gran):
-                    if zy == 0 or zy < 0:
-                        continue
-                    new_w = hh.GetBinContent(zx,zy)+w
-                    hh.SetBinContent(zx,zy,new_w)
-    hh.Draw('COLZ')
-    hh.Write()
-    f.Close()
+    binning = image_binning(x_side, y_side, gran)
+    (xh_nbins, xh_low, xh_high), (yh_nbins, yh_low, yh_high) = binning
+    hh = gHistogram('pet', 'Sources imaging', binning, ['x [mm]', 'y [mm]'])
+    _i, _j = np.meshgrid(np.arange(-xh_nbins//2, xh_nbins//2), \
+                         np.arange(-yh_nbins//2, yh_nbins//2), indexing='ij')
+    hh.fill(_i.ravel(), _j.ravel())
+    if len(lines_list) > 0:
+        rows, pixels, lengths = lines_pixels(lines_list, binning)
+        _w = np.asarray(rate_list, dtype=np.float64)[rows]*lengths/\
+             ((xh_high - xh_low)/xh_nbins)
+        points = gHistogram('points', 'points', hh.binning)
+        points.content[1:-1, 1:-1] = np.bincount(pixels, weights=_w, \
+                    minlength=xh_nbins*yh_nbins).reshape((xh_nbins, yh_nbins))
+        smear_x = _smear_matrix(xh_nbins, *psf_kernel(kernel, \
+                                x_side/float(xh_nbins), gran, sigma))
+        smear_y = _smear_matrix(yh_nbins, *psf_kernel(kernel, \
+                                y_side/float(yh_nbins), gran, sigma))
+        if kernel == 'box':
+            hh.content += points.content
+        hh.content += smear_x.dot(points.content).dot(smear_y.T)
+    save_histograms(os.path.join(ADVLAB_OUT,outfile), [hh])
     logger.info('Created %s'%os.path.join(ADVLAB_OUT,outfile))
      
-def build_rate_hist(th_label, infile_list, yref_list):
-    """
-    """
-    rate_list = []
-    ncoinc_list = []
-    for f in infile_list:
-        ch, t, e = process_data(f, [0,2])
-        coinc_file_name = os.path.basename(f.replace('.dat', '_COINC.dat'))
-        coinc_file = os.path.join(ADVLAB_DATA, coinc_file_name)
-        check_double_coinc(t[0], t[1], e[0], e[1], 10, coinc_file)
-        t1, e1, t2, e2 = parse_coinc_data(coinc_file)
-        e1_mev = channel2energy(e1, 0)
-        e2_mev = channel2energy(e2, 2)
-        _mask0 = (e1_mev < 1.) & (e1_mev > 0.1) 
-        _mask2 = (e2_mev < 1.) & (e2_mev > 0.1)
-        _mask = _mask0 & _mask2
-        t1_w, e1_mev_w, t2_w, e2_mev_w = t1[_mask], e1_mev[_mask], t2[_mask],\
-                                 e2_mev[_mask]
-        logger.info('%i/%i coincidences in the selected energy window' %\
-                    (len(t1_w),len(t1)))
-        num_coinc = len(t1_w)
-        time_interval = (t[0][-1] - t[0][0])/10000000
-        logger.info('effective time interval = %i s'%time_interval)
-        rate = float(num_coinc)/time_interval
-        logger.info('Rate = %.5f s^{-1}'%rate)
-        rate_list.append(rate)
-        ncoinc_list.append(num_coinc)
-    root_file_name = os.path.join(ADVLAB_OUT,'y_scan.root')
-    if not os.path.exists(root_file_name):
-        root_file = ROOT.TFile(root_file_name,'RECREATE')
+def _count_coinc(args):
+    """Count the coincidences in the energy window of a scan file, and
+       return them with the rate.
+    """
+    f, time_window, selection = args
+    events = process_events(f, COINC_CHANNELS)
+    # The window is anchored to the channel with fewer events before the
+    # energy selection, as it has always been done for the scans.
+    swap = len(events[0]) > len(events[1])
+    t1, e1, t2, e2 = get_double_coinc(f, COINC_CHANNELS, time_window, \
+                                      events=events, selection=selection, \
+                                      swap=swap)
+    num_coinc = len(t1)
+    logger.info('%s: %i coincidences in the selected energy window' %\
+                (os.path.basename(f), num_coinc))
+    time_interval = (events[0]['t'][-1] - events[0]['t'][0])*TICK_NS/10000000
+    logger.info('effective time interval = %i s'%time_interval)
+    rate = float(num_coinc)/time_interval
+    logger.info('Rate = %.5f s^{-1}'%rate)
+    return num_coinc, rate
+
+def count_coinc(infile_list, time_window=10, jobs=1):
+    """Return the number of coincidences in the energy window and the rate
+       for each file of a list, in the same order.
+
+       The files are independent, and with jobs > 1 they are shared among
+       a pool of processes.
+
+       Arguments
+       ---------
+       infile_list : list of str
+           the scan files
+       time_window : int
+           coincidence window, in ns
+       jobs : int
+           number of processes
+    """
+    # The energy window is applied to the events (as a lookup table over
+    # the ADC channels) before the coincidence search.
+    selection = energy_selection(COINC_CHANNELS, *ENERGY_WINDOW)
+    args = [(f, time_window, selection) for f in infile_list]
+    jobs = max(1, min(jobs, len(args)))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.map(_count_coinc, args)
+        pool.close()
+        pool.join()
     else:
-        root_file = ROOT.TFile(root_file_name,'UPDATE')
-    nbins = len(yref_list) - 1
-    y_min, y_max = 70 - yref_list[0], 70 - yref_list[-1]
-    h = ROOT.TH1F(th_label, th_label, nbins, y_min , y_max)
-    #h.Sumw2()
-    ybox_list = []
-    for i, c in enumerate(ncoinc_list):
-        y = 70 - yref_list[i]
-        ybox_list.append(y)
-        h.Fill(y, c)
-    h.GetXaxis().SetTitle('y [mm]')
-    h.GetYaxis().SetTitle('Number of Coincidences')
-    h.Write()
-    root_file.Close()
-    logger.info('Created %s'%root_file_name)
+        results = [_count_coinc(a) for a in args]
+    ncoinc_list = [r[0] for r in results]
+    rate_list = [r[1] for r in results]
+    return ncoinc_list, rate_list
+
+def rate_hist(th_label, yref_list, ncoinc_list):
+    """Return the position y of the box for each position of a scan, and
+       the histogram of the coincidences as a function of y (named
+       th_label).
+
+       The positions may come in any order: the axis goes from the lowest
+       to the highest one, padded by half a step (the smallest distance
+       between two positions) on each side, so that each position falls
+       in its own bin.
+    """
+    ybox_list = [70 - yref for yref in yref_list]
+    _y = np.unique(ybox_list)
+    step = np.diff(_y).min() if len(_y) > 1 else 1.
+    nbins = int(round((_y[-1] - _y[0])/step)) + 1
+    h = gHistogram(th_label, th_label, \
+                   [(nbins, _y[0] - 0.5*step, _y[-1] + 0.5*step)], \
+                   ['y [mm]', 'Number of Coincidences'])
+    h.fill(ybox_list, weights=ncoinc_list)
+    return ybox_list, h
+
+def build_rate_hist(th_label, infile_list, yref_list, time_window=10, \
+                    outfile=None, return_hist=False, jobs=1):
+    """Count the coincidences in the energy window for each position of
+       a scan at a given angle, and build the histogram of the counts as a
+       function of y (named th_label).
+
+       The histogram is returned if return_hist is True, to be passed to
+       gAnalysisUtils.find_peaks_fit, and it is added to outfile (in
+       ADVLAB_OUT) only if outfile is not None.
+    """
+    ncoinc_list, rate_list = count_coinc(infile_list, time_window, jobs)
+    ybox_list, h = rate_hist(th_label, yref_list, ncoinc_list)
+    if outfile is not None:
+        save_scan_hists([h], outfile, update=True)
+    if return_hist == True:
+        return ybox_list, ncoinc_list, h
     return ybox_list, ncoinc_list
 
+def build_rate_hists(thet_list, infile_list, yref_list, time_window=10, \
+                     jobs=1):
+    """Same as build_rate_hist, for the scans at all the angles at once
+       (all the files are shared among the processes).
+
+       Returns a list with th, the positions y of the box, the numbers
+       of coincidences and the histogram (named th<th>) for each angle,
+       in increasing order of angle.
+
+       Arguments
+       ---------
+       thet_list : list of float
+           angle of the scan of each file
+       infile_list : list of str
+           the scan files
+       yref_list : list of float
+           position of the scan of each file
+       time_window : int
+           coincidence window, in ns
+       jobs : int
+           number of processes
+    """
+    thet_list = np.array(thet_list)
+    yref_list = np.array(yref_list)
+    ncoinc_list = np.array(count_coinc(infile_list, time_window, jobs)[0])
+    scans = []
+    for th in np.unique(thet_list):
+        _index = np.where(thet_list == th)
+        ybox_list, h = rate_hist('th%i'%th, yref_list[_index], \
+                                 ncoinc_list[_index])
+        scans.append((th, ybox_list, list(ncoinc_list[_index]), h))
+    return scans
+
+def save_scan_hists(hist_list, outfile=SCAN_FILE_NAME, update=False):
+    """Write the histograms of the scans in outfile, in ADVLAB_OUT.
+    """
+    out_file_name = os.path.join(ADVLAB_OUT, outfile)
+    save_histograms(out_file_name, hist_list, update=update)
+    logger.info('Created %s'%out_file_name)
+
 def main():
     """Simple test code.
     """
@@ -0,0 +1,287 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Binary cache of the parsed data files.
+
+   The numpy arrays obtained parsing a data file are stored as raw .npy
+   columns (that can be memory-mapped) in a hidden folder next to the
+   file itself, e.g. data/.advlab_cache/scan_0_40.dat/t.npy, together
+   with a small json file with the size, modification time and sha1 of
+   the original file. The cache is used only if the file has not changed
+   since then.
+
+   The same folder holds the results of the analysis steps run on the
+   file (e.g. the coincidences), keyed by the sha1 of the file and by the
+   parameters of the step.
+
+   Results that do not depend on any data file (e.g. the system matrix of
+   a scan geometry) are stored in the same kind of folder in ADVLAB_OUT,
+   keyed by their parameters only.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from advlab import ADVLAB_OUT
+from advlab.utils.logging_ import logger
+
+CACHE_FOLDER_NAME = '.advlab_cache'
+# Bump this whenever the content or the format of the cached columns
+# changes, to invalidate the existing caches.
+CACHE_VERSION = 2
+
+
+def file_sha1(file_path, block_size=1 << 20):
+    """Return the sha1 hex digest of the content of a file.
+    """
+    sha1 = hashlib.sha1()
+    f = open(file_path, 'rb')
+    block = f.read(block_size)
+    while block:
+        sha1.update(block)
+        block = f.read(block_size)
+    f.close()
+    return sha1.hexdigest()
+
+def file_signature(file_path):
+    """Return the size and modification time of a file.
+    """
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def cache_dir(file_path):
+    """Return the path of the cache folder of a given file.
+    """
+    file_path = os.path.abspath(file_path)
+    return os.path.join(os.path.dirname(file_path), CACHE_FOLDER_NAME, \
+                        os.path.basename(file_path))
+
+def _meta_file(file_path):
+    return os.path.join(cache_dir(file_path), 'meta.json')
+
+def _column_file(file_path, name):
+    return os.path.join(cache_dir(file_path), '%s.npy' % name)
+
+def _write_meta(file_path, meta):
+    meta_file = _meta_file(file_path)
+    f = open(meta_file + '.tmp', 'w')
+    json.dump(meta, f)
+    f.close()
+    os.rename(meta_file + '.tmp', meta_file)
+
+def is_valid(file_path, names):
+    """Check whether the cache of a given file exists and is up to date.
+
+       The cache is valid if the size and the modification time of the
+       file did not change; if only the modification time changed (e.g.
+       the file has been copied or touched), the sha1 of the content is
+       compared, and the cache is revalidated if it matches.
+    """
+    meta_file = _meta_file(file_path)
+    if not os.path.exists(meta_file):
+        return False
+    try:
+        meta = json.load(open(meta_file))
+    except ValueError:
+        return False
+    if meta.get('version') != CACHE_VERSION or \
+       meta.get('columns') != list(names):
+        return False
+    for name in names:
+        if not os.path.exists(_column_file(file_path, name)):
+            return False
+    signature = file_signature(file_path)
+    if signature['size'] != meta['size']:
+        return False
+    if signature['mtime'] == meta['mtime']:
+        return True
+    if file_sha1(file_path) != meta['sha1']:
+        return False
+    meta.update(signature)
+    try:
+        _write_meta(file_path, meta)
+    except (IOError, OSError):
+        pass
+    return True
+
+def load_columns(file_path, names, mmap_mode='r'):
+    """Load the cached columns of a given file (memory-mapped by
+       default), or return None if the cache is missing or outdated.
+    """
+    if not is_valid(file_path, names):
+        return None
+    return [np.load(_column_file(file_path, name), mmap_mode=mmap_mode) \
+            for name in names]
+
+def save_columns(file_path, names, columns):
+    """Save the columns obtained from a given file in its cache folder.
+
+       The json file, written last, marks the cache as complete. Errors
+       (e.g. a read-only data folder) are only logged, since the cache
+       is not essential.
+    """
+    try:
+        folder = cache_dir(file_path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        if os.path.exists(_meta_file(file_path)):
+            os.remove(_meta_file(file_path))
+        meta = file_signature(file_path)
+        meta.update({'version': CACHE_VERSION, 'columns': list(names),
+                     'sha1': file_sha1(file_path)})
+        for name, column in zip(names, columns):
+            column_file = _column_file(file_path, name)
+            f = open(column_file + '.tmp', 'wb')
+            np.save(f, np.asarray(column))
+            f.close()
+            os.rename(column_file + '.tmp', column_file)
+        _write_meta(file_path, meta)
+    except (IOError, OSError) as e:
+        logger.warning('Cannot write the cache of %s (%s)' % (file_path, e))
+
+def cached_columns(file_path, names, function):
+    """Return the columns obtained by function(file_path), reading them
+       from the cache if it is up to date and filling it otherwise.
+    """
+    columns = load_columns(file_path, names)
+    if columns is not None:
+        logger.info('Reading cached data for %s...' % file_path)
+        return columns
+    columns = function(file_path)
+    save_columns(file_path, names, columns)
+    return columns
+
+def content_sha1(file_path):
+    """Return the sha1 of the content of a file, taken from the metadata
+       of its cache if the file did not change in the meantime.
+    """
+    try:
+        meta = json.load(open(_meta_file(file_path)))
+    except (IOError, OSError, ValueError):
+        meta = {}
+    signature = file_signature(file_path)
+    if 'sha1' in meta and meta.get('size') == signature['size'] and \
+       meta.get('mtime') == signature['mtime']:
+        return meta['sha1']
+    return file_sha1(file_path)
+
+def _normalize(params):
+    return json.loads(json.dumps(params, sort_keys=True))
+
+def _result_file(file_path, name, params):
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir(file_path), '%s_%s.npy' % \
+                        (name, key.hexdigest()[:12]))
+
+def load_result(file_path, name, params, mmap_mode='r'):
+    """Load the result of an analysis step run on a given file with the
+       given parameters (a json-serializable dict), or return None if it
+       is missing or if the file has changed since.
+    """
+    result_file = _result_file(file_path, name, params)
+    try:
+        meta = json.load(open(result_file.replace('.npy', '.json')))
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION or \
+       meta.get('params') != _normalize(params) or \
+       not os.path.exists(result_file) or \
+       meta.get('sha1') != content_sha1(file_path):
+        return None
+    return np.load(result_file, mmap_mode=mmap_mode)
+
+def save_result(file_path, name, params, result):
+    """Save the result (a numpy array) of an analysis step run on a given
+       file with the given parameters.
+    """
+    result_file = _result_file(file_path, name, params)
+    meta_file = result_file.replace('.npy', '.json')
+    try:
+        if not os.path.exists(os.path.dirname(result_file)):
+            os.makedirs(os.path.dirname(result_file))
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        f = open(result_file + '.tmp', 'wb')
+        np.save(f, np.asarray(result))
+        f.close()
+        os.rename(result_file + '.tmp', result_file)
+        meta = {'version': CACHE_VERSION, 'params': params,
+                'sha1': content_sha1(file_path)}
+        f = open(meta_file + '.tmp', 'w')
+        json.dump(meta, f)
+        f.close()
+        os.rename(meta_file + '.tmp', meta_file)
+    except (IOError, OSError) as e:
+        logger.warning('Cannot write the cache of %s (%s)' % (file_path, e))
+
+def cached_result(file_path, name, params, function):
+    """Return the result of function(), reading it from the cache of the
+       given file if available and filling the cache otherwise.
+    """
+    result = load_result(file_path, name, params)
+    if result is not None:
+        logger.info('Reading cached %s for %s...' % (name, file_path))
+        return result
+    result = function()
+    save_result(file_path, name, params, result)
+    return result
+
+def _arrays_file(name, params):
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return os.path.join(ADVLAB_OUT, CACHE_FOLDER_NAME, '%s_%s.npz' % \
+                        (name, key.hexdigest()[:12]))
+
+def load_arrays(name, params):
+    """Load the arrays (a dict) stored with the given name and parameters
+       (a json-serializable dict), or return None if they are missing.
+    """
+    arrays_file = _arrays_file(name, params)
+    try:
+        f = np.load(arrays_file)
+        meta = json.loads(str(f['__meta__']))
+        arrays = dict((key, f[key]) for key in f.files if key != '__meta__')
+        f.close()
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if meta.get('version') != CACHE_VERSION or \
+       meta.get('params') != _normalize(params):
+        return None
+    return arrays
+
+def save_arrays(name, params, arrays):
+    """Save a dict of numpy arrays with the given name and parameters.
+    """
+    arrays_file = _arrays_file(name, params)
+    try:
+        if not os.path.exists(os.path.dirname(arrays_file)):
+            os.makedirs(os.path.dirname(arrays_file))
+        meta = json.dumps({'version': CACHE_VERSION, 'params': params})
+        f = open(arrays_file + '.tmp', 'wb')
+        np.savez(f, __meta__=np.array(meta), **arrays)
+        f.close()
+        os.rename(arrays_file + '.tmp', arrays_file)
+    except (IOError, OSError) as e:
+        logger.warning('Cannot write the cache of %s (%s)' % (name, e))
+
+def cached_arrays(name, params, function):
+    """Return the arrays (a dict) returned by function(), reading them
+       from the cache if available and filling the cache otherwise.
+    """
+    arrays = load_arrays(name, params)
+    if arrays is not None:
+        logger.info('Reading cached %s...' % name)
+        return arrays
+    arrays = function()
+    save_arrays(name, params, arrays)
+    return arrays
@@ -0,0 +1,292 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Registry of the energy calibrations of the channels.
+
+   Each calibration table is a json file in config/calibration, named after
+   its version, with the calibration points (ADC channel, energy in MeV) of
+   each channel and, optionally, the coefficients of the linear calibration
+   (slope and offset); if they are missing, they are fitted to the points.
+   The tables are read (and fitted) only once per session.
+"""
+
+import os
+import json
+import numpy as np
+
+from advlab import ADVLAB_CONFIG
+from advlab.utils.logging_ import logger
+from advlab.utils.gParsing import MAX_ADC_CHANNEL, make_selection
+
+CALIB_FOLDER = os.path.join(ADVLAB_CONFIG, 'calibration')
+DEFAULT_CALIB_VERSION = 'gr2_20160630'
+
+"""Quality requirements of a fitted calibration: maximum distance [MeV]
+   of each point from the line, and maximum chi2 per degree of freedom,
+   with an uncertainty of CALIB_SIGMA [MeV] on the energy of each point.
+"""
+MAX_CALIB_RESIDUAL = 0.05
+MAX_CALIB_CHI2 = 5.
+CALIB_SIGMA = 0.02
+
+"""Energies [MeV] of the photopeaks used for the calibration, for each
+   source (as in the SRC variable of the configuration files).
+"""
+SOURCE_LINES = {
+    'Ba' : [0.03, 0.356],
+    'Na' : [0.511, 1.27],
+    'Cs' : [0.662],
+    'Co' : [1.17, 1.33],
+}
+
+
+class gCalibration(object):
+
+    """Linear energy calibration of a set of channels.
+    """
+
+    def __init__(self, version, points, coefficients=None, description=''):
+        """Constructor.
+
+        Arguments
+        ---------
+        version : str
+            name of the calibration table
+        points : dict
+            channel -> list of (ADC channel, energy [MeV]) pairs
+        coefficients : dict
+            channel -> (slope, offset); fitted to the points if missing
+        description : str
+            free text
+        """
+        self.version = version
+        self.description = description
+        self.points = dict((int(ch), [tuple(p) for p in _points]) \
+                           for ch, _points in points.items())
+        self.coefficients = {}
+        for ch, _points in self.points.items():
+            if coefficients is not None and ch in coefficients:
+                p = tuple(coefficients[ch])
+            else:
+                _ch, _en = np.array(_points, dtype=np.float64).T
+                p = tuple(np.polyfit(_ch, _en, 1))
+            logger.info('Energy fit parameters (ch%i, %s): [0]=%f, [1]=%f' %\
+                        (ch, version, p[0], p[1]))
+            self.coefficients[ch] = p
+        self._lut = {}
+
+    def channels(self):
+        return sorted(self.coefficients.keys())
+
+    def lookup_table(self, ch_num):
+        """Return the energy [MeV] of each ADC channel of the given channel,
+           from 0 to MAX_ADC_CHANNEL.
+        """
+        if ch_num not in self._lut:
+            slope, offset = self.coefficients[ch_num]
+            self._lut[ch_num] = offset + \
+                np.arange(MAX_ADC_CHANNEL + 1, dtype=np.float64)*slope
+        return self._lut[ch_num]
+
+    def to_energy(self, _e, ch_num):
+        """Convert an array of ADC channels of the given channel into
+           energies [MeV].
+
+           Unsigned 8 or 16 bit integers (e.g. the 'e' field of the events)
+           are converted through the lookup table, any other type with a
+           single multiply-add pass.
+        """
+        _e = np.asarray(_e)
+        if _e.dtype in (np.uint8, np.uint16):
+            return self.lookup_table(ch_num)[_e]
+        slope, offset = self.coefficients[ch_num]
+        en_array = np.multiply(_e, slope, dtype=np.float64)
+        en_array += offset
+        return en_array
+
+    def energy_window(self, ch_num, emin, emax):
+        """Return a boolean array, over the ADC channels, True for the
+           energies between emin and emax [MeV] (excluded).
+        """
+        _lut = self.lookup_table(ch_num)
+        return (_lut > emin) & (_lut < emax)
+
+    def residuals(self, ch_num):
+        """Return the differences between the calibrated energies of the
+           points of the given channel and their known energies [MeV].
+        """
+        _ch, _en = np.array(self.points[ch_num], dtype=np.float64).T
+        slope, offset = self.coefficients[ch_num]
+        return offset + slope*_ch - _en
+
+    def to_dict(self):
+        return {'version': self.version, 'description': self.description,
+                'channels': dict((str(ch), \
+                                  {'points': [list(p) for p in self.points[ch]],
+                                   'coefficients': list(self.coefficients[ch])})\
+                                 for ch in self.channels())}
+
+
+def find_photopeaks(centers, content, num_peaks, smoothing=5, window=3):
+    """Return the positions of the num_peaks most prominent peaks of a
+       spectrum, in increasing order.
+
+       The spectrum is smoothed with a moving average over smoothing bins,
+       the local maxima are ranked by their prominence, and the position
+       of each selected peak is refined with the centroid of the (not
+       smoothed) contents within window bins from the maximum.
+
+       Arguments
+       ---------
+       centers : numpy array
+           bin centers of the spectrum
+       content : numpy array
+           bin contents of the spectrum
+       num_peaks : int
+           number of peaks to return
+       smoothing : int
+           width (in bins) of the moving average
+       window : int
+           half width (in bins) of the centroid window
+    """
+    from scipy.signal import find_peaks
+    kernel = np.ones(smoothing)/float(smoothing)
+    smooth = np.convolve(content, kernel, mode='same')
+    index, props = find_peaks(smooth, prominence=0)
+    if len(index) < num_peaks:
+        return None
+    index = np.sort(index[np.argsort(props['prominences'])[::-1][:num_peaks]])
+    # All the centroid windows at once, clipped at the edges.
+    _win = np.clip(index[:, None] + np.arange(-window, window + 1), \
+                   0, len(content) - 1)
+    weights = content[_win]
+    norm = np.maximum(weights.sum(axis=1), 1)
+    return (centers[_win]*weights).sum(axis=1)/norm
+
+def energy_selection(num_of_channels, emin, emax, \
+                     version=DEFAULT_CALIB_VERSION):
+    """Return the selection table (see gParsing.make_selection) keeping
+       the events of the given channels with calibrated energy between
+       emin and emax [MeV] (excluded).
+    """
+    calib = load_calibration(version)
+    return make_selection(num_of_channels, \
+                          dict((ch, calib.energy_window(ch, emin, emax)) \
+                               for ch in num_of_channels))
+
+def fit_calibration(version, points, description='', \
+                    max_residual=MAX_CALIB_RESIDUAL, max_chi2=MAX_CALIB_CHI2):
+    """Return the calibration fitted, for each channel, to the points of
+       all the sources together.
+
+       The fit is rejected (ValueError) if any point is farther than
+       max_residual from the line, or if the chi2 per degree of freedom
+       (with an uncertainty of CALIB_SIGMA on each energy) exceeds
+       max_chi2, e.g. when a Compton edge has been taken for a photopeak.
+
+       Arguments
+       ---------
+       version : str
+           name of the new calibration table
+       points : dict
+           channel -> list of (ADC channel, energy [MeV]) pairs
+       description : str
+           free text
+       max_residual : float
+           maximum distance [MeV] of a point from the line
+       max_chi2 : float
+           maximum chi2 per degree of freedom
+    """
+    for ch, _points in points.items():
+        if len(_points) < 2:
+            raise ValueError('Channel %i: %i calibration points found, ' \
+                             'at least 2 needed' % (ch, len(_points)))
+    calib = gCalibration(version, points, description=description)
+    for ch in calib.channels():
+        res = calib.residuals(ch)
+        for (adc, en), r in zip(calib.points[ch], res):
+            logger.info('ch%i: channel %.1f -> %.3f MeV (residual %+.4f MeV)'%\
+                        (ch, adc, en, r))
+        dof = len(res) - 2
+        if dof == 0:
+            logger.warning('ch%i: only 2 points, the linearity is not '\
+                           'checked' % ch)
+            continue
+        chi2 = (res**2).sum()/CALIB_SIGMA**2/dof
+        logger.info('ch%i: max residual %.4f MeV, chi2/dof = %.2f' %\
+                    (ch, np.abs(res).max(), chi2))
+        if np.abs(res).max() > max_residual or chi2 > max_chi2:
+            raise ValueError('Channel %i: bad calibration fit (max residual '\
+                             '%.4f MeV, chi2/dof %.2f), check the matching '\
+                             'of the peaks' % (ch, np.abs(res).max(), chi2))
+    return calib
+
+
+"""Calibrations already loaded: version -> gCalibration.
+"""
+_REGISTRY = {}
+
+def calib_file(version):
+    """Return the path of the table of a given calibration version.
+    """
+    return os.path.join(CALIB_FOLDER, '%s.json' % version)
+
+def list_calibrations():
+    """Return the versions of the available calibration tables.
+    """
+    return sorted(f[:-5] for f in os.listdir(CALIB_FOLDER) \
+                  if f.endswith('.json'))
+
+def load_calibration(version=DEFAULT_CALIB_VERSION):
+    """Return the calibration with the given version, reading its table
+       only the first time.
+    """
+    if version not in _REGISTRY:
+        file_path = calib_file(version)
+        if not os.path.exists(file_path):
+            raise ValueError('Unknown calibration %s (choose among %s)' %\
+                             (version, ', '.join(list_calibrations())))
+        table = json.load(open(file_path))
+        channels = table['channels']
+        points = dict((int(ch), item['points']) \
+                      for ch, item in channels.items())
+        coefficients = dict((int(ch), item['coefficients']) \
+                            for ch, item in channels.items() \
+                            if 'coefficients' in item)
+        _REGISTRY[version] = gCalibration(version, points, coefficients, \
+                                          table.get('description', ''))
+    return _REGISTRY[version]
+
+def save_calibration(calib, folder=CALIB_FOLDER):
+    """Write a calibration table (in config/calibration by default), and
+       register it.
+    """
+    file_path = os.path.join(folder, '%s.json' % calib.version)
+    f = open(file_path, 'w')
+    json.dump(calib.to_dict(), f, indent=4, sort_keys=True)
+    f.close()
+    _REGISTRY[calib.version] = calib
+    logger.info('Created %s' % file_path)
+    return file_path
+
+
+def main():
+    """Simple test code.
+    """
+    calib = load_calibration()
+    for ch in calib.channels():
+        logger.info('Channel %i: %s' % (ch, calib.to_energy(\
+                    np.array([0, 1000, 5000], dtype=np.uint16), ch)))
+
+
+if __name__ == '__main__':
+    main()
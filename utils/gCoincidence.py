@@ -0,0 +1,305 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Coincidences among any number of CAEN channels
+"""
+
+import hashlib
+import numpy as np
+
+from advlab.utils.logging_ import logger
+from advlab.utils.gAnalysisUtils import find_double_coinc
+from advlab.utils.gParsing import iter_events, iter_process_events, TICK_NS
+from advlab.utils.gParsing import process_events, make_coinc, select_events
+from advlab.utils.gParsing import DEFAULT_CHUNK_SIZE
+from advlab.utils.gCache import cached_result
+
+
+def _group_starts(t_all, half_window):
+    """Return the indices of the first events of the groups of a
+       time-ordered stream, each group starting with the first event after
+       the window of the previous one.
+
+       The chain of the group starts is followed by pointer doubling (each
+       round doubles the number of starts found), so that the number of
+       numpy passes grows only as the log of the number of groups.
+    """
+    num = len(t_all)
+    jump = np.append(np.searchsorted(t_all, t_all + half_window, \
+                                     side='right'), num)
+    starts = np.array([0])
+    while starts[-1] != num:
+        starts = np.union1d(starts, jump[starts])
+        jump = jump[jump]
+    return starts[:-1]
+
+def find_multi_coinc(t_list, time_window, min_fold=2, tick=1, ref=None):
+    """Find the coincidences of at least min_fold different channels.
+
+       The window has the same width as in find_double_coinc, i.e.
+       time_window/2, and it is anchored to one event, so that no
+       coincidence is longer than that:
+       - if ref is None, all the events are merged in time order and each
+         group starts with the first event not yet in a group, and spans
+         the window after it;
+       - otherwise, each event of the channel ref (position in t_list)
+         starts a group, spanning the window before it, exactly as
+         find_double_coinc does for the events of _t1.
+
+       Returns an array with one row per coincidence and one column per
+       channel, with the index of the event of each channel in the
+       coincidence, or -1 if the channel is missing. If a channel has
+       more events in the same window, there is one row for each
+       combination of them (as find_double_coinc returns all the pairs);
+       the rows are sorted by group and then by index, the last channel
+       varying fastest.
+
+       Arguments
+       ---------
+       t_list : list of numpy arrays of int
+           arrival times of the events of each channel (time-ordered)
+       time_window : float
+           coincidence window
+       min_fold : int
+           minimum number of channels in coincidence
+       tick : int
+           unit of the arrival times in terms of the unit of time_window
+       ref : int
+           channel (position in t_list) whose events anchor the groups
+    """
+    half_window = (time_window/2)/float(tick)
+    num_channels = len(t_list)
+    t_list = [np.asarray(_t) for _t in t_list]
+    if ref is None:
+        t_all = np.sort(np.concatenate(t_list), kind='mergesort')
+        t0 = t_all[_group_starts(t_all, half_window)] if len(t_all) else t_all
+        low = [np.searchsorted(_t, t0, side='left') for _t in t_list]
+        high = [np.searchsorted(_t, t0 + half_window, side='right') \
+                for _t in t_list]
+    else:
+        t0 = t_list[ref]
+        low = [np.searchsorted(_t, t0 - half_window, side='left') \
+               for _t in t_list]
+        high = [np.searchsorted(_t, t0, side='right') for _t in t_list]
+        low[ref] = np.arange(len(t0))
+        high[ref] = low[ref] + 1
+    low = np.array(low, dtype=np.int64).reshape((num_channels, len(t0))).T
+    high = np.array(high, dtype=np.int64).reshape((num_channels, len(t0))).T
+    hits = np.clip(high - low, 0, None)
+    _mask = (hits > 0).sum(axis=1) >= min_fold
+    low, hits = low[_mask], hits[_mask]
+    # Expand the combinations of the events in each group (one digit per
+    # channel, in mixed radix).
+    radix = np.maximum(hits, 1)
+    size = radix.prod(axis=1)
+    group = np.repeat(np.arange(len(size)), size)
+    digits = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+    table = np.full((len(group), num_channels), -1, dtype=np.int64)
+    for i in reversed(range(num_channels)):
+        _radix = radix[group, i]
+        table[:, i] = np.where(hits[group, i] > 0, \
+                               low[group, i] + digits % _radix, -1)
+        digits = digits // _radix
+    logger.info('%i coincidences of at least %i channels found!' %\
+                (len(table), min_fold))
+    return table
+
+def multi_coinc_events(events_list, table):
+    """Return, for each channel, the events in the coincidences found by
+       find_multi_coinc (and a mask of the coincidences including it).
+
+       Arguments
+       ---------
+       events_list : list of numpy arrays
+           the arrays (e.g. of gParsing.EVENT_DTYPE records) of each channel
+       table : numpy array of int
+           the table returned by find_multi_coinc
+    """
+    selected = []
+    for i, events in enumerate(events_list):
+        _mask = table[:, i] >= 0
+        selected.append((events[table[_mask, i]], _mask))
+    return selected
+
+def _double_coinc_pairs(ev_ref, ev_other, time_window, tick, swap):
+    """Return (t1, e1, t2, e2) for the pairs of events in coincidence,
+       with the window before the events of ev_ref.
+    """
+    i_ref, i_other = find_double_coinc(ev_ref['t'], ev_other['t'], \
+                                       time_window, tick)
+    ev_ref, ev_other = ev_ref[i_ref], ev_other[i_other]
+    if swap:
+        ev_ref, ev_other = ev_other, ev_ref
+    return ev_ref['t']*tick, ev_ref['e'], ev_other['t']*tick, ev_other['e']
+
+def iter_double_coinc(chunks, time_window, tick=1, swap=False):
+    """Incremental version of gAnalysisUtils.double_coinc.
+
+       Takes an iterable of time-ordered chunks, each one a pair of arrays
+       of events of the first and second channel (as yielded, e.g., by
+       gParsing.iter_process_events), and yields the (t1, e1, t2, e2)
+       arrays of the coincidences found so far after each chunk.
+
+       An event of the reference channel is final as soon as a later
+       chunk starts, since all the events still to come are later; the
+       events of the other channel are kept only for one coincidence
+       window before the latest time stamp, so that no pair is lost
+       across the chunk boundaries and the memory usage is constant.
+       Concatenating the output gives the same result as double_coinc.
+
+       Arguments
+       ---------
+       chunks : iterable
+           pairs of arrays with the fields 't' and 'e', in time order
+       time_window : float
+           coincidence window
+       tick : int
+           unit of the time stamps in terms of the unit of time_window
+       swap : bool
+           if True, take the window before the events of the second
+           channel (double_coinc does so if it has fewer events)
+    """
+    half_window = (time_window/2)/float(tick)
+    pending, buffer = None, None
+    for chunk in chunks:
+        ev_ref, ev_other = (chunk[1], chunk[0]) if swap else chunk
+        if pending is None:
+            pending, buffer = ev_ref[:0], ev_other[:0]
+        pending = np.concatenate((pending, ev_ref))
+        buffer = np.concatenate((buffer, ev_other))
+        if len(ev_ref) + len(ev_other) == 0:
+            continue
+        t_mark = max([ev['t'][-1] for ev in (ev_ref, ev_other) if len(ev)])
+        _num = np.searchsorted(pending['t'], t_mark, side='left')
+        yield _double_coinc_pairs(pending[:_num], buffer, time_window, \
+                                  tick, swap)
+        pending = pending[_num:]
+        t_min = t_mark - half_window
+        if np.issubdtype(buffer['t'].dtype, np.integer):
+            t_min = int(np.ceil(t_min))
+        buffer = buffer[np.searchsorted(buffer['t'], t_min, side='left'):]
+    if pending is not None:
+        yield _double_coinc_pairs(pending, buffer, time_window, tick, swap)
+
+def count_events(file_path, num_of_channels, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Count the events of the given channels reading the file in chunks.
+    """
+    counts = np.zeros(len(num_of_channels), dtype=np.int64)
+    for chunk in iter_events(file_path, chunk_size):
+        for i, channel in enumerate(num_of_channels):
+            counts[i] += np.count_nonzero(chunk['ch'] == channel)
+    return counts
+
+def stream_double_coinc(file_path, num_of_channels, time_window, \
+                        chunk_size=DEFAULT_CHUNK_SIZE, swap=None):
+    """Find the coincidences between two channels of a data file reading
+       it in chunks (see iter_double_coinc), with constant memory.
+
+       Yields the (t1, e1, t2, e2) arrays, with the times in ns, as the
+       coincidences are found.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the file to process
+       num_of_channels : list of int
+           the two channels (0, 1, 2, or 3)
+       time_window : float
+           coincidence window in ns
+       chunk_size : int
+           number of events read at a time
+       swap : bool
+           whether the window is taken before the events of the second
+           channel; if None, as in double_coinc, i.e. if the second
+           channel has fewer events (which takes a first pass to count)
+    """
+    if swap is None:
+        counts = count_events(file_path, num_of_channels, chunk_size)
+        swap = counts[0] > counts[1]
+    chunks = iter_process_events(file_path, num_of_channels, chunk_size)
+    for coinc in iter_double_coinc(chunks, time_window, TICK_NS, swap):
+        yield coinc
+
+def get_double_coinc(file_path, num_of_channels, time_window, events=None, \
+                     use_cache=True, selection=None, swap=None):
+    """Return the (t1, e1, t2, e2) arrays of the coincidences between two
+       channels of a data file (see gAnalysisUtils.double_coinc), with
+       the times in ns.
+
+       The pairs are found by find_multi_coinc, anchored to the events of
+       the channel with fewer events (as double_coinc).
+
+       The result is stored in the cache of the file (see gCache), keyed
+       by the content of the file, the channels and the window, so that
+       it is computed only once for each set of parameters.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the data file
+       num_of_channels : list of int
+           the two channels (0, 1, 2, or 3)
+       time_window : float
+           coincidence window in ns
+       events : list of numpy arrays
+           the events of the two channels, as returned by
+           gParsing.process_events, if already available
+       use_cache : bool
+           if False, always compute the coincidences
+       selection : numpy array
+           selection table (see gParsing.make_selection) applied to the
+           events before the coincidence search
+       swap : bool
+           see gAnalysisUtils.double_coinc; note that, if None, it depends
+           on the number of events of each channel after the selection
+    """
+    def _compute():
+        _events = events
+        if _events is None:
+            _events = process_events(file_path, num_of_channels)
+        ev1, ev2 = [select_events(ev, selection) for ev in _events]
+        _swap = len(ev1) > len(ev2) if swap is None else swap
+        logger.info('Scanning the data to find coincidences...')
+        table = find_multi_coinc([ev1['t'], ev2['t']], time_window, 2, \
+                                 TICK_NS, 1 if _swap else 0)
+        ev1, ev2 = ev1[table[:, 0]], ev2[table[:, 1]]
+        coinc = make_coinc(ev1['t']*TICK_NS, ev1['e'], ev2['t']*TICK_NS, \
+                           ev2['e'])
+        logger.info('%i pairs of coincident events found!' % len(coinc))
+        return coinc
+    if use_cache:
+        params = {'channels': list(num_of_channels),
+                  'time_window': time_window}
+        if selection is not None:
+            params['selection'] = hashlib.sha1(selection.tobytes()).hexdigest()
+        if swap is not None:
+            params['swap'] = bool(swap)
+        coinc = cached_result(file_path, 'coinc', params, _compute)
+    else:
+        coinc = _compute()
+    return coinc['t1'], coinc['e1'], coinc['t2'], coinc['e2']
+
+def main():
+    """Simple test code.
+    """
+    import os
+    from advlab import ADVLAB_DATA
+    from advlab.utils.gParsing import process_events
+    infile = os.path.join(ADVLAB_DATA, 'run_gr2_20160630_coinc_0.dat')
+    events_list = process_events(infile, [0, 1, 2, 3])
+    table = find_multi_coinc([ev['t'] for ev in events_list], 20, \
+                             tick=TICK_NS)
+    logger.info('Channels in coincidence: %s' % (table >= 0).sum(axis=0))
+
+
+if __name__ == '__main__':
+    main()
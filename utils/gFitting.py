@@ -0,0 +1,164 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Batch fitting of many histograms at once.
+
+   The histograms are stacked in 2d arrays (one row per histogram, padded
+   to the same number of bins with zero weights), and a Levenberg-Marquardt
+   minimization of the chi2 of all of them is run with numpy operations on
+   the whole stack, each row with its own damping.
+"""
+
+import multiprocessing
+import numpy as np
+
+from advlab.utils.logging_ import logger
+
+DOUBLE_GAUS_NPAR = 6
+
+
+def double_gaus(x, a1, mu1, sig1, a2, mu2, sig2):
+    """Sum of two gaussians (as the ROOT formula 'gaus(0)+gaus(3)').
+    """
+    return a1*np.exp(-0.5*((x - mu1)/sig1)**2) + \
+           a2*np.exp(-0.5*((x - mu2)/sig2)**2)
+
+def _double_gaus_jacobian(x, p):
+    """Return the model and its derivatives with respect to the parameters,
+       for the parameters p (one row per histogram) and the abscissae x
+       (one row per histogram).
+    """
+    jac = np.empty(x.shape + (DOUBLE_GAUS_NPAR,))
+    model = np.zeros(x.shape)
+    for k in (0, 3):
+        a, mu, sig = [p[:, k + i, None] for i in range(3)]
+        u = (x - mu)/sig
+        g = np.exp(-0.5*u**2)
+        model += a*g
+        jac[..., k] = g
+        jac[..., k + 1] = a*g*u/sig
+        jac[..., k + 2] = a*g*u**2/sig
+    return model, jac
+
+def _in_range(p, x_range):
+    """Return True for the parameters with both the means inside the range
+       of the histogram and both the widths positive and smaller than it.
+    """
+    lo, hi = x_range[:, 0], x_range[:, 1]
+    ok = np.ones(len(p), dtype=bool)
+    for k in (0, 3):
+        ok &= (p[:, k + 1] >= lo) & (p[:, k + 1] <= hi)
+        ok &= (p[:, k + 2] > 0) & (p[:, k + 2] <= hi - lo)
+    return ok
+
+def _fit_batch(args):
+    """Levenberg-Marquardt minimization for a stack of histograms.
+    """
+    x, y, w, p0, x_range, max_iter, tolerance = args
+    p = np.array(p0, dtype=np.float64)
+    lam = np.full(len(p), 1e-3)
+    active = np.ones(len(p), dtype=bool)
+    model, jac = _double_gaus_jacobian(x, p)
+    chi2 = ((w*(model - y))**2).sum(axis=1)
+    eye = np.eye(DOUBLE_GAUS_NPAR)
+    for i in range(max_iter):
+        if not active.any():
+            break
+        _p, _x, _y, _w = p[active], x[active], y[active], w[active]
+        model, jac = _double_gaus_jacobian(_x, _p)
+        wjac = _w[..., None]*jac
+        alpha = np.einsum('nbi,nbj->nij', wjac, wjac)
+        beta = -np.einsum('nbi,nb->ni', wjac, _w*(model - _y))
+        damping = lam[active, None, None]*(alpha*eye + 1e-12*eye)
+        step = np.linalg.solve(alpha + damping, beta[..., None])[..., 0]
+        new_p = _p + step
+        new_model = _double_gaus_jacobian(_x, new_p)[0]
+        new_chi2 = ((_w*(new_model - _y))**2).sum(axis=1)
+        better = np.isfinite(new_chi2) & (new_chi2 <= chi2[active]) & \
+                 _in_range(new_p, x_range[active])
+        index = np.flatnonzero(active)
+        converged = better & (chi2[active] - new_chi2 <= \
+                              tolerance*np.maximum(new_chi2, 1e-300))
+        p[index[better]] = new_p[better]
+        chi2[index[better]] = new_chi2[better]
+        lam[index] = np.where(better, lam[index]/10., lam[index]*10.)
+        active[index[converged | (lam[index] > 1e10)]] = False
+    model, jac = _double_gaus_jacobian(x, p)
+    wjac = w[..., None]*jac
+    alpha = np.einsum('nbi,nbj->nij', wjac, wjac)
+    cov = np.linalg.pinv(alpha)
+    err = np.sqrt(np.abs(np.diagonal(cov, axis1=1, axis2=2)))
+    return p, err, chi2
+
+def fit_double_gaus_batch(x_list, y_list, p0_list, jobs=1, max_iter=200, \
+                          tolerance=1e-10):
+    """Fit a double gaussian to each histogram of a list, all at once.
+
+       The chi2 is built with the errors of the contents taken as
+       sqrt(content), skipping the empty bins (as TH1::Fit), and the
+       errors of the parameters are not rescaled by the chi2. The steps
+       moving a mean outside the range of the bin centers, or making a
+       width negative or larger than this range, are rejected. Histograms
+       with no more non-empty bins than parameters are not fitted, and
+       their initial parameters are returned with errors equal to the
+       initial width.
+
+       Returns the arrays of the parameters and of their errors (one row
+       per histogram).
+
+       Arguments
+       ---------
+       x_list : list of numpy arrays
+           bin centers of each histogram
+       y_list : list of numpy arrays
+           bin contents of each histogram
+       p0_list : list of lists
+           initial parameters (a1, mu1, sig1, a2, mu2, sig2) of each fit
+       jobs : int
+           number of processes sharing the histograms
+       max_iter : int
+           maximum number of iterations
+       tolerance : float
+           relative decrease of the chi2 below which a fit has converged
+    """
+    num = len(x_list)
+    size = max([len(_x) for _x in x_list] + [1])
+    x = np.zeros((num, size))
+    y = np.zeros((num, size))
+    x_range = np.zeros((num, 2))
+    for i, (_x, _y) in enumerate(zip(x_list, y_list)):
+        x[i, :len(_x)] = _x
+        y[i, :len(_y)] = _y
+        x_range[i] = _x.min(), _x.max()
+    w = np.where(y > 0, 1./np.sqrt(np.maximum(y, 1e-300)), 0.)
+    p0 = np.array(p0_list, dtype=np.float64).reshape((num, DOUBLE_GAUS_NPAR))
+    par, err = p0.copy(), np.repeat(p0[:, 2:3], DOUBLE_GAUS_NPAR, axis=1)
+    fit = np.count_nonzero(w, axis=1) > DOUBLE_GAUS_NPAR
+    if not fit.all():
+        logger.warning('Too few bins for %i fit(s), using the initial values'%\
+                       np.count_nonzero(~fit))
+    index = np.flatnonzero(fit)
+    if len(index) == 0:
+        return par, err
+    chunks = np.array_split(index, max(1, min(jobs, len(index))))
+    args = [(x[c], y[c], w[c], p0[c], x_range[c], max_iter, tolerance) \
+            for c in chunks]
+    if len(chunks) > 1:
+        pool = multiprocessing.Pool(len(chunks))
+        results = pool.map(_fit_batch, args)
+        pool.close()
+        pool.join()
+    else:
+        results = [_fit_batch(args[0])]
+    for c, (_par, _err, _chi2) in zip(chunks, results):
+        par[c], err[c] = _par, _err
+    return par, err
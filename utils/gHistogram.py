@@ -0,0 +1,362 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Vectorized histogramming with the ROOT binning conventions.
+
+   The contents are computed with numpy in a single pass and include the
+   underflow (index 0) and overflow (index nbins + 1) bins, as in ROOT,
+   so that they can be copied in bulk into a TH1F/TH2F.
+
+   The gHistogram class keeps the contents in numpy arrays and writes
+   them in .npz or HDF5 files, so that the analysis does not need ROOT;
+   the conversion to ROOT histograms is only done on request. Since the
+   binning is fixed, histograms filled with different chunks of data,
+   files or processes can be merged at the end.
+"""
+
+import os
+import json
+import numpy as np
+
+
+def bin_index(x, nbins, xmin, xmax):
+    """Return the ROOT bin number of each value (0 for the underflow and
+       nbins + 1 for the overflow), as TAxis::FindBin.
+    """
+    if not xmin < xmax:
+        raise ValueError('Invalid axis range [%s, %s]' % (xmin, xmax))
+    x = np.asarray(x, dtype=np.float64)
+    index = np.floor(nbins*(x - xmin)/(xmax - xmin)).astype(np.int64) + 1
+    return np.clip(index, 0, nbins + 1)
+
+def histogram1d(x, nbins, xmin, xmax, weights=None):
+    """Return the contents of a 1d histogram, including the underflow and
+       overflow bins (nbins + 2 values).
+    """
+    index = bin_index(x, nbins, xmin, xmax)
+    return np.bincount(index, weights=weights, minlength=nbins + 2)\
+             .astype(np.float64)
+
+def histogram2d(x, y, nbinsx, xmin, xmax, nbinsy, ymin, ymax, weights=None):
+    """Return the contents of a 2d histogram, including the underflow and
+       overflow bins, as an array of shape (nbinsx + 2, nbinsy + 2).
+    """
+    index = bin_index(x, nbinsx, xmin, xmax)*(nbinsy + 2) + \
+            bin_index(y, nbinsy, ymin, ymax)
+    counts = np.bincount(index, weights=weights, \
+                         minlength=(nbinsx + 2)*(nbinsy + 2))
+    return counts.astype(np.float64).reshape((nbinsx + 2, nbinsy + 2))
+
+def _set_root_content(h, content, entries):
+    """Copy the bin contents (in the ROOT global bin order) into a ROOT
+       histogram, and update its statistics.
+    """
+    h.SetContent(np.ascontiguousarray(content, dtype=np.float64))
+    h.ResetStats()
+    if entries is not None:
+        h.SetEntries(entries)
+    return h
+
+def root_hist1d(name, title, counts, xmin, xmax, entries=None):
+    """Create a TH1F with the contents returned by histogram1d.
+    """
+    import ROOT
+    h = ROOT.TH1F(name, title, len(counts) - 2, xmin, xmax)
+    return _set_root_content(h, counts, entries)
+
+def root_hist2d(name, title, counts, xmin, xmax, ymin, ymax, entries=None):
+    """Create a TH2F with the contents returned by histogram2d.
+    """
+    import ROOT
+    nbinsx, nbinsy = counts.shape[0] - 2, counts.shape[1] - 2
+    h = ROOT.TH2F(name, title, nbinsx, xmin, xmax, nbinsy, ymin, ymax)
+    # ROOT global bin number: binx + (nbinsx + 2)*biny
+    return _set_root_content(h, counts.T.ravel(), entries)
+
+
+class gHistogram(object):
+
+    """Pure numpy 1d or 2d histogram, with the ROOT binning conventions.
+
+    The contents include the underflow and overflow bins, so that the
+    histogram can be exported to a TH1F/TH2F without any loss; it can be
+    saved in .npz or HDF5 files (see save_histograms) without ROOT.
+    """
+
+    def __init__(self, name, title, binning, labels=None):
+        """Constructor.
+
+        Arguments
+        ---------
+        name : str
+            name of the histogram (also used as the key in the files)
+        title : str
+            title of the histogram
+        binning : list of tuples
+            (nbins, min, max) for each axis
+        labels : list of str
+            titles of the axes
+        """
+        self.name = name
+        self.title = title
+        self.binning = [(int(n), float(lo), float(hi)) for n, lo, hi in binning]
+        for n, lo, hi in self.binning:
+            if n < 1 or not lo < hi:
+                raise ValueError('Invalid binning (%i, %s, %s) for %s' %\
+                                 (n, lo, hi, name))
+        self.labels = list(labels or ['']*len(self.binning))
+        self.content = np.zeros([n + 2 for n, lo, hi in self.binning])
+        self.entries = 0
+
+    def ndim(self):
+        return len(self.binning)
+
+    def edges(self, axis=0):
+        """Return the bin edges along the given axis.
+        """
+        nbins, lo, hi = self.binning[axis]
+        return np.linspace(lo, hi, nbins + 1)
+
+    def centers(self, axis=0):
+        """Return the bin centers along the given axis.
+        """
+        _edges = self.edges(axis)
+        return 0.5*(_edges[1:] + _edges[:-1])
+
+    def values(self):
+        """Return the contents without the underflow and overflow bins.
+        """
+        return self.content[(slice(1, -1),)*self.ndim()]
+
+    def find_bin(self, *values):
+        """Return the bin number (as TAxis::FindBin) of the values along
+           each axis.
+        """
+        return tuple(bin_index(v, *b) for v, b in zip(values, self.binning))
+
+    def fill(self, *values, **kwargs):
+        """Fill the histogram with arrays of values (one for each axis),
+           with optional weights (keyword argument).
+        """
+        weights = kwargs.get('weights')
+        if self.ndim() == 1:
+            counts = histogram1d(values[0], *self.binning[0], weights=weights)
+        else:
+            (nx, xmin, xmax), (ny, ymin, ymax) = self.binning
+            counts = histogram2d(values[0], values[1], nx, xmin, xmax, \
+                                 ny, ymin, ymax, weights=weights)
+        self.content += counts
+        self.entries += len(values[0])
+
+    def add(self, chunk, weights=None):
+        """Accumulate a chunk of data: an array of values for a 1d
+           histogram, or a pair of arrays (x, y) for a 2d one.
+        """
+        if self.ndim() == 1:
+            chunk = (chunk,)
+        self.fill(*chunk, weights=weights)
+        return self
+
+    def merge(self, other):
+        """Add the contents of another histogram with the same binning
+           (e.g. filled with another chunk, file or process).
+        """
+        if other.binning != self.binning:
+            raise ValueError('Cannot merge %s with %s (different binning)' %\
+                             (self, other))
+        self.content += other.content
+        self.entries += other.entries
+        return self
+
+    def copy(self, name=None):
+        """Return a copy of the histogram (with a new name, if given).
+        """
+        hist = gHistogram(name or self.name, self.title, self.binning, \
+                          self.labels)
+        hist.content = self.content.copy()
+        hist.entries = self.entries
+        return hist
+
+    def plot(self, **kwargs):
+        """Draw the histogram with matplotlib (as plt.hist or plt.hist2d,
+           with the same keyword arguments).
+
+           matplotlib is imported only here, so that the histograms can be
+           filled and saved without it.
+        """
+        from advlab.utils.matplotlib_ import pyplot as plt
+        if self.ndim() == 1:
+            return plt.hist(self.centers(), bins=self.edges(), \
+                            weights=self.values(), **kwargs)
+        x, y = np.meshgrid(self.centers(0), self.centers(1), indexing='ij')
+        return plt.hist2d(x.ravel(), y.ravel(), \
+                          bins=[self.edges(0), self.edges(1)], \
+                          weights=self.values().ravel(), **kwargs)
+
+    def to_root(self):
+        """Return a TH1F/TH2F with the same binning and contents.
+        """
+        if self.ndim() == 1:
+            nbins, xmin, xmax = self.binning[0]
+            h = root_hist1d(self.name, self.title, self.content, xmin, xmax, \
+                            self.entries)
+        else:
+            (nx, xmin, xmax), (ny, ymin, ymax) = self.binning
+            h = root_hist2d(self.name, self.title, self.content, xmin, xmax, \
+                            ymin, ymax, self.entries)
+        for axis, label in zip([h.GetXaxis(), h.GetYaxis()], self.labels):
+            axis.SetTitle(label)
+        return h
+
+    @classmethod
+    def from_root(cls, h):
+        """Create a histogram from a TH1/TH2.
+        """
+        axes = [h.GetXaxis()]
+        if h.GetDimension() == 2:
+            axes.append(h.GetYaxis())
+        binning = [(a.GetNbins(), a.GetXmin(), a.GetXmax()) for a in axes]
+        hist = cls(h.GetName(), h.GetTitle(), binning, \
+                   [a.GetTitle() for a in axes])
+        shape = hist.content.shape
+        for index in np.ndindex(*shape):
+            hist.content[index] = h.GetBinContent(*index)
+        hist.entries = int(h.GetEntries())
+        return hist
+
+    def _meta(self):
+        return {'title': self.title, 'labels': self.labels,
+                'entries': self.entries}
+
+    def __repr__(self):
+        return 'gHistogram(%s, %s)' % (self.name, self.binning)
+
+
+def spectrum_accumulator(name, tot_num_en_ch, nbins, ndim=1):
+    """Return an empty energy spectrum (1d) or energy scatter plot (2d)
+       with nbins bins between 0 and tot_num_en_ch on each axis, as set
+       by TOT_NUM_EN_CH and NBINS in the configuration files.
+    """
+    return gHistogram(name, name, [(nbins, 0, tot_num_en_ch)]*ndim)
+
+def merge_histograms(hist_list, name=None):
+    """Return the sum of a list of histograms with the same binning.
+    """
+    hist = hist_list[0].copy(name)
+    for other in hist_list[1:]:
+        hist.merge(other)
+    return hist
+
+def _str(name):
+    if not isinstance(name, str):
+        name = name.decode('utf-8')
+    return str(name)
+
+def _npz_histograms(file_path):
+    data = np.load(file_path)
+    hist_list = []
+    for name in data['names']:
+        name = _str(name)
+        meta = json.loads(str(data['%s/meta' % name]))
+        hist = gHistogram(name, meta['title'], data['%s/binning' % name], \
+                          meta['labels'])
+        hist.content = data['%s/content' % name].astype(np.float64)
+        hist.entries = meta['entries']
+        hist_list.append(hist)
+    return hist_list
+
+def _h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('h5py is needed to read/write HDF5 files ' +\
+                          '(use the .npz format otherwise)')
+    return h5py
+
+def _is_hdf5(file_path):
+    return os.path.splitext(file_path)[1] in ['.h5', '.hdf5']
+
+def _is_root(file_path):
+    return file_path.endswith('.root')
+
+def load_histograms(file_path):
+    """Read all the histograms from a .npz, HDF5 (.h5, .hdf5) or ROOT file,
+       in the order they were written.
+    """
+    if _is_root(file_path):
+        import ROOT
+        f = ROOT.TFile(file_path)
+        hist_list = [gHistogram.from_root(f.Get(key.GetName())) \
+                     for key in f.GetListOfKeys()]
+        f.Close()
+        return hist_list
+    if _is_hdf5(file_path):
+        f = _h5py().File(file_path, 'r')
+        hist_list = []
+        for name in f.attrs['names']:
+            name = _str(name)
+            group = f[name]
+            meta = json.loads(group.attrs['meta'])
+            hist = gHistogram(name, meta['title'], group['binning'][()], \
+                              meta['labels'])
+            hist.content = group['content'][()].astype(np.float64)
+            hist.entries = meta['entries']
+            hist_list.append(hist)
+        f.close()
+        return hist_list
+    return _npz_histograms(file_path)
+
+def save_histograms(file_path, hist_list, update=False):
+    """Write a list of histograms in a .npz, HDF5 (.h5, .hdf5) or ROOT
+       file, depending on the extension.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the output file
+       hist_list : list of gHistogram
+           the histograms to write
+       update : bool
+           if True, the histograms are added to those already in the file
+           (replacing the ones with the same name)
+    """
+    if _is_root(file_path):
+        import ROOT
+        mode = 'UPDATE' if update and os.path.exists(file_path) else 'RECREATE'
+        f = ROOT.TFile(file_path, mode)
+        for hist in hist_list:
+            hist.to_root().Write(hist.name, ROOT.TObject.kOverwrite)
+        f.Close()
+        return
+    if update and os.path.exists(file_path):
+        names = [hist.name for hist in hist_list]
+        hist_list = [hist for hist in load_histograms(file_path) \
+                     if hist.name not in names] + list(hist_list)
+    if _is_hdf5(file_path):
+        f = _h5py().File(file_path, 'w')
+        f.attrs['names'] = [hist.name.encode('utf-8') for hist in hist_list]
+        for hist in hist_list:
+            group = f.create_group(hist.name)
+            group.create_dataset('content', data=hist.content)
+            group.create_dataset('binning', data=np.array(hist.binning))
+            group.attrs['meta'] = json.dumps(hist._meta())
+        f.close()
+        return
+    arrays = {'names': np.array([hist.name for hist in hist_list])}
+    for hist in hist_list:
+        arrays['%s/content' % hist.name] = hist.content
+        arrays['%s/binning' % hist.name] = np.array(hist.binning)
+        arrays['%s/meta' % hist.name] = np.array(json.dumps(hist._meta()))
+    # np.savez appends .npz to the file names without it.
+    f = open(file_path, 'wb')
+    np.savez(f, **arrays)
+    f.close()
@@ -5,27 +5,53 @@
 
 import numpy as np
 import os
-import ROOT
-from ROOT import *
+import warnings
 
 from advlab.utils.logging_ import logger
+from advlab.utils.gCache import cached_columns
 from advlab.utils.matplotlib_ import pyplot as plt
 
 
-def parse_data(file_path):
-    """Parse the ASCII file with events.   
-       
-       Arguments
-       ---------
-       file_path : str
-           path and name of the file to process
+# Number of whitespace-separated columns in a CAEN event line:
+# channel, time stamp, energy channel and two unused fields.
+NUM_CAEN_COLUMNS = 5
+
+# Default parameters of the streaming reader: number of events per chunk,
+# bytes read from the file at a time and maximum time disorder of the
+# events (in units of the CAEN clock, i.e. 10 ns).
+DEFAULT_CHUNK_SIZE = 1000000
+DEFAULT_BLOCK_SIZE = 1 << 24
+DEFAULT_REORDER_WINDOW = 1000000
+
+# Period of the CAEN clock, i.e. unit of the time stamps, in ns.
+TICK_NS = 10
+# Largest energy channel that fits in an event record.
+MAX_ADC_CHANNEL = 65535
+# Number of input channels of the CAEN module.
+NUM_CAEN_CHANNELS = 4
+
+# Compact record of a CAEN event: channel, time stamp (in units of the
+# CAEN clock) and energy channel; 11 bytes per event instead of 24.
+EVENT_DTYPE = np.dtype([('ch', np.int8), ('t', np.int64), ('e', np.uint16)])
+
+# Record of a pair of coincident events: time (in ns) and energy of the
+# event of the first and of the second channel.
+COINC_DTYPE = np.dtype([('t1', np.int64), ('e1', np.float32),
+                        ('t2', np.int64), ('e2', np.float32)])
+# First bytes of the files written by np.save.
+NPY_MAGIC = b'\x93NUMPY'
+
+def _parse_lines(lines):
+    """Parse a list of CAEN event lines one by one, skipping the lines
+       that cannot be converted to exactly NUM_CAEN_COLUMNS numbers.
+
+       This is the slow path of parse_data, used only when the file
+       contains lines that the vectorized loader cannot handle.
     """
     ch = []
     t = []
     e = []
-    f = open(file_path).readlines()
-    lim = int(len(f)/3)
-    for line in f[0:-1]:
+    for line in lines:
         try:
             _ch, _t, _e, _boh1, _boh2 = [float(item) for item in line.split()]
             ch.append(_ch)
@@ -38,34 +64,237 @@ def parse_data(file_path):
     e = np.array(e)
     return ch, t, e
 
+def _count_tokens_per_line(text):
+    """Return the number of whitespace-separated tokens on each line
+       of a block of text ending with a newline.
+
+       Any control character is treated as a separator here: a line
+       containing an unexpected one is caught later on, since the C
+       tokenizer refuses to convert it.
+    """
+    buf = np.frombuffer(text, dtype=np.uint8)
+    space = buf <= ord(' ')
+    token_start = ~space
+    token_start[1:] &= space[:-1]
+    line_end = np.flatnonzero(buf == ord('\n'))
+    ntokens = np.searchsorted(np.flatnonzero(token_start), line_end)
+    return np.diff(np.concatenate(([0], ntokens)))
+
+def _tokenize(text, dtype, size):
+    """Convert a block of whitespace-separated numbers with the C
+       tokenizer of numpy, returning None if the block does not contain
+       exactly size numbers of the given type.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(text, dtype=dtype, sep=' ')
+    except ValueError:
+        return None
+    if len(values) != size:
+        return None
+    return values
+
+def _parse_block(text):
+    """Parse a block of complete CAEN event lines (i.e. ending with a
+       newline) into the channel, time and energy arrays.
+
+       The numbers are tokenized in C by np.fromstring (as integers,
+       which is what the CAEN module writes, or as floats otherwise);
+       lines with the wrong number of columns are dropped beforehand,
+       and if some token is not a number the block is handed to the
+       line-by-line parser, so that malformed lines are skipped exactly
+       as before.
+    """
+    if len(text) == 0:
+        return _parse_lines([])
+    ntokens = _count_tokens_per_line(text)
+    _good = ntokens == NUM_CAEN_COLUMNS
+    if not np.all(_good):
+        lines = text.split(b'\n')
+        text = b''.join([lines[i] + b'\n' for i in np.flatnonzero(_good)])
+    nlines = np.count_nonzero(_good)
+    if nlines == 0:
+        return _parse_lines([])
+    values = _tokenize(text, np.int64, nlines*NUM_CAEN_COLUMNS)
+    if values is None:
+        values = _tokenize(text, np.float64, nlines*NUM_CAEN_COLUMNS)
+    if values is None:
+        return _parse_lines(text.split(b'\n'))
+    values = values.reshape((nlines, NUM_CAEN_COLUMNS))
+    ch = values[:, 0].astype(np.float64)
+    t = values[:, 1].astype(np.int64)
+    e = values[:, 2].astype(np.float64)
+    return ch, t, e
+
+def parse_data(file_path):
+    """Parse the ASCII file with events.   
+       
+       The last line of the file is always discarded, since it may be
+       truncated if the acquisition has been stopped while writing.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the file to process
+    """
+    text = open(file_path, 'rb').read()
+    text = text[:text.rfind(b'\n', 0, len(text) - 1) + 1]
+    return _parse_block(text)
+
+def make_events(_ch, _t, _e):
+    """Pack the channel, time and energy arrays returned by parse_data
+       in an array of EVENT_DTYPE records.
+
+       Energies outside the range of the ADC are clipped (with a warning).
+    """
+    events = np.empty(len(_t), dtype=EVENT_DTYPE)
+    events['ch'] = _ch
+    events['t'] = _t
+    if len(_e) > 0 and (_e.min() < 0 or _e.max() > MAX_ADC_CHANNEL):
+        logger.warning('Energy channels outside [0, %i] clipped' %\
+                       MAX_ADC_CHANNEL)
+        _e = np.clip(_e, 0, MAX_ADC_CHANNEL)
+    events['e'] = _e
+    return events
+
+def event_columns(events):
+    """Inverse of make_events: return the channel, time and energy
+       arrays, with the same types as parse_data.
+    """
+    return events['ch'].astype(np.float64), events['t'].astype(np.int64), \
+        events['e'].astype(np.float64)
+
+def parse_events(file_path):
+    """Parse the ASCII file with events into an array of EVENT_DTYPE
+       records (see parse_data).
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the file to process
+    """
+    return make_events(*parse_data(file_path))
+
+def _parse_events_columns(file_path):
+    return [parse_events(file_path)]
+
+def load_events(file_path, use_cache=True):
+    """Same as parse_events, but the event records are stored in a
+       binary cache next to the file, and read back (memory-mapped) as
+       long as the file does not change.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the file to process
+       use_cache : bool
+           if False, always parse the ASCII file
+    """
+    if not use_cache:
+        return parse_events(file_path)
+    return cached_columns(file_path, ('events',), _parse_events_columns)[0]
+
+def load_data(file_path, use_cache=True):
+    """Same as parse_data, but reading the events through the binary
+       cache (see load_events).
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the file to process
+       use_cache : bool
+           if False, always parse the ASCII file
+    """
+    return event_columns(load_events(file_path, use_cache))
+
+def write_coinc_data(file_path, t1, e1, t2, e2, text=False):
+    """Write the coincident pairs of events to file.
+
+       By default the pairs are saved (with np.save) as a single array of
+       COINC_DTYPE records, i.e. the records of the coincidence store of
+       gCoincidence.get_double_coinc; with text=True the legacy ASCII
+       format (one '%i %.2f %i %.2f' line per pair) is written instead.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the output file
+       t1, e1, t2, e2 : numpy arrays
+           times (in ns) and energies of the events of the two channels
+       text : bool
+           if True, write the legacy ASCII format
+    """
+    if not text:
+        f = open(file_path, 'wb')
+        np.save(f, make_coinc(t1, e1, t2, e2))
+        f.close()
+        return
+    f = open(file_path, 'wb')
+    f.write(b'#FIRST CHANNEL\t#SECOND CHANNEL \n\n')
+    f.write(b'#time - energy\t#time -  energy \n\n')
+    for line in zip(t1, e1, t2, e2):
+        f.write(('%i %.2f %i %.2f\n' % line).encode('ascii'))
+    f.close()
+
+def _parse_coinc_lines(file_path):
+    """Parse a legacy ASCII file of coincidences line by line, skipping
+       the lines that cannot be converted to exactly four numbers.
+    """
+    values = []
+    for line in open(file_path):
+        try:
+            _t1, _e1, _t2, _e2 = [float(item) for item in line.split()]
+        except ValueError:
+            continue
+        values.append((_t1, _e1, _t2, _e2))
+    return np.array(values, dtype=np.float64).reshape((len(values), 4))
+
 def parse_coinc_data(file_path):
-    """Parse the ASCII file with coincident pairs of events.
+    """Parse the file with coincident pairs of events.
+
+       The binary files (see write_coinc_data) are recognized by the
+       header of np.save and memory-mapped, with no parsing; legacy ASCII
+       files are read with np.loadtxt, or line by line if some line is
+       malformed. In both cases the energies are returned as floats.
 
        Arguments     
        ---------                            
        file_path : str 
            path and name of the file of coincidences to process
     """
-    t1 = []
-    t2 = []
-    e1 = []
-    e2 = []
-    for line in open(file_path):
-        try:
-            _t1, _e1, _t2, _e2 = [float(item) for item in line.split()]
-            t1.append(_t1)
-            t2.append(_t2)
-            e1.append(_e1)
-            e2.append(_e2)
-        except:
-            pass
-    t1 = np.array(t1, dtype=np.int64)
-    t2 = np.array(t2, dtype=np.int64)
-    e1 = np.array(e1, dtype=np.int32)
-    e2 = np.array(e2, dtype=np.int32)
+    f = open(file_path, 'rb')
+    magic = f.read(len(NPY_MAGIC))
+    f.close()
+    if magic == NPY_MAGIC:
+        coinc = np.load(file_path, mmap_mode='r')
+        return coinc['t1'], coinc['e1'], coinc['t2'], coinc['e2']
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            values = np.loadtxt(file_path, dtype=np.float64, comments='#', \
+                                ndmin=2)
+        if values.size == 0:
+            values = values.reshape((0, 4))
+        if values.shape[1] != 4:
+            raise ValueError('Wrong number of columns')
+    except ValueError:
+        values = _parse_coinc_lines(file_path)
+    t1 = values[:, 0].astype(COINC_DTYPE['t1'])
+    e1 = values[:, 1].astype(COINC_DTYPE['e1'])
+    t2 = values[:, 2].astype(COINC_DTYPE['t2'])
+    e2 = values[:, 3].astype(COINC_DTYPE['e2'])
     return t1, e1, t2, e2
 
-def process_data(file_path, num_of_channels):
+def make_coinc(t1, e1, t2, e2):
+    """Pack the arrays of coincident events in an array of COINC_DTYPE
+       records.
+    """
+    coinc = np.empty(len(t1), dtype=COINC_DTYPE)
+    coinc['t1'], coinc['e1'], coinc['t2'], coinc['e2'] = t1, e1, t2, e2
+    return coinc
+
+def process_data(file_path, num_of_channels, use_cache=True):
     """Parse the ASCII file with the GRB light curve data from Swift.   
        
        Arguments
@@ -75,24 +304,215 @@ def process_data(file_path, num_of_channels):
        num_of_channels : list of int
            the number of the channels used in the CAEN module; 
            in our case we must choose among 4 channels (0, 1, 2, or 3)
+       use_cache : bool
+           if True, use the binary cache of the parsed file (see load_data)
     """
-    logger.info('Parsing data file...')
-    _ch, _t, _e = parse_data(file_path)
-    _index = np.argsort(_t)
-    _ch = _ch[_index] 
-    _t = _t[_index]
-    _e = _e[_index]
     ch, t, e = [], [], []
-    logger.info('splitting the channels...')
-    _t = _t*10
     logger.info('Time is returned in ns...')
-    for channel in num_of_channels:
-        _mask = np.where(_ch == channel)
-        ch.append(_ch[_mask])
-        t.append(_t[_mask])
-        e.append(_e[_mask])
+    for events in process_events(file_path, num_of_channels, use_cache):
+        _ch, _t, _e = event_columns(events)
+        ch.append(_ch)
+        t.append(_t*TICK_NS)
+        e.append(_e)
     return ch, t, e
 
+def make_selection(num_of_channels, accept=None):
+    """Return a selection table, i.e. a boolean array with one row per CAEN
+       channel (NUM_CAEN_CHANNELS, or more if a larger channel is given)
+       and one column per energy channel, True for the events to keep.
+
+       Arguments
+       ---------
+       num_of_channels : list of int
+           the channels to keep (0, 1, 2, or 3)
+       accept : dict
+           channel -> boolean array of size MAX_ADC_CHANNEL + 1, with the
+           energy channels to keep (all of them for the missing channels)
+    """
+    for ch in num_of_channels:
+        if ch < 0:
+            raise ValueError('Invalid channel %i in the selection' % ch)
+    num_rows = max([NUM_CAEN_CHANNELS] + [ch + 1 for ch in num_of_channels])
+    selection = np.zeros((num_rows, MAX_ADC_CHANNEL + 1), dtype=bool)
+    for ch in num_of_channels:
+        if accept is not None and ch in accept:
+            selection[ch] = accept[ch]
+        else:
+            selection[ch] = True
+    return selection
+
+def select_events(events, selection):
+    """Return the events passing a selection table (see make_selection),
+       with a single lookup for all the events; the events of the channels
+       outside the table (e.g. negative ones) are dropped.
+    """
+    if selection is None:
+        return events
+    ch = events['ch'].astype(np.int64)
+    _valid = (ch >= 0) & (ch < len(selection))
+    if _valid.all():
+        return events[selection[ch, events['e']]]
+    _mask = np.zeros(len(events), dtype=bool)
+    _mask[_valid] = selection[ch[_valid], events['e'][_valid]]
+    return events[_mask]
+
+def process_events(file_path, num_of_channels, use_cache=True, selection=None):
+    """Compact version of process_data: return a list with the
+       time-ordered EVENT_DTYPE records of each requested channel.
+
+       The time stamps are left in units of the CAEN clock (TICK_NS),
+       and the per-channel arrays are views of a single array.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the file to process
+       num_of_channels : list of int
+           the channels to select (0, 1, 2, or 3)
+       use_cache : bool
+           if True, use the binary cache of the parsed file (see load_events)
+       selection : numpy array
+           if not None, keep only the events passing this selection table
+           (see make_selection), before splitting the channels
+    """
+    logger.info('Parsing data file...')
+    events = load_events(file_path, use_cache)
+    if selection is not None:
+        events = select_events(events, selection)
+        logger.info('%i events selected' % len(events))
+    logger.info('splitting the channels...')
+    return demux_events(events, num_of_channels)
+
+def _is_sorted(a):
+    return np.all(a[1:] >= a[:-1])
+
+def demux_events(events, num_of_channels):
+    """Split an array of events in the requested channels, in time order.
+
+       The events of all the channels are grouped at once with a stable
+       sort on the channel number (skipped if they are already grouped),
+       so that each channel is a contiguous slice (i.e. a view) of the
+       grouped array, still in the order of the input; a channel is
+       time-ordered (making a copy) only if it is not already (the CAEN
+       module writes each channel in time order).
+
+       Arguments
+       ---------
+       events : numpy array of EVENT_DTYPE
+           the events to split
+       num_of_channels : list of int
+           the channels to select (0, 1, 2, or 3)
+    """
+    if not _is_sorted(events['ch']):
+        events = events[np.argsort(events['ch'], kind='mergesort')]
+    _start = np.searchsorted(events['ch'], num_of_channels, side='left')
+    _stop = np.searchsorted(events['ch'], num_of_channels, side='right')
+    channels = [events[i:j] for i, j in zip(_start, _stop)]
+    for i, _events in enumerate(channels):
+        if not _is_sorted(_events['t']):
+            channels[i] = _events[np.argsort(_events['t'], kind='mergesort')]
+    return channels
+
+def _iter_blocks(file_path, block_size):
+    """Read a file in blocks of (about) block_size bytes, each one made
+       of complete lines.
+
+       As in parse_data, the last line of the file is never returned.
+    """
+    f = open(file_path, 'rb')
+    carry = b''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        block = carry + block
+        _last = block.rfind(b'\n', 0, len(block) - 1) + 1
+        carry = block[_last:]
+        if _last > 0:
+            yield block[:_last]
+    f.close()
+
+def iter_events(file_path, chunk_size=DEFAULT_CHUNK_SIZE, \
+                block_size=DEFAULT_BLOCK_SIZE, selection=None):
+    """Generator parsing the ASCII file with events in chunks.
+
+       Yields arrays of EVENT_DTYPE records (as returned by parse_events)
+       of chunk_size consecutive events at a time (the last chunk can be
+       shorter), reading block_size bytes of the file at a time, so that
+       the memory usage does not depend on the size of the file.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the file to process
+       chunk_size : int
+           number of events per chunk
+       block_size : int
+           number of bytes read from the file at a time
+       selection : numpy array
+           if not None, keep only the events passing this selection table
+           (see make_selection), as soon as each block is parsed
+    """
+    pending = np.empty(0, dtype=EVENT_DTYPE)
+    for block in _iter_blocks(file_path, block_size):
+        events = select_events(make_events(*_parse_block(block)), selection)
+        pending = np.concatenate((pending, events))
+        while len(pending) >= chunk_size:
+            yield pending[:chunk_size]
+            pending = pending[chunk_size:]
+    if len(pending) > 0:
+        yield pending
+
+def iter_process_events(file_path, num_of_channels, \
+                        chunk_size=DEFAULT_CHUNK_SIZE, \
+                        reorder_window=DEFAULT_REORDER_WINDOW, selection=None):
+    """Streaming version of process_events.
+
+       The events are read in chunks with iter_events, time-ordered and
+       split in the requested channels, and for each chunk the list of
+       the events of each channel (as returned by process_events) is
+       yielded. Consecutive chunks are in time order too.
+
+       The CAEN events are written almost in time order: to sort the
+       stream with bounded memory, the events less than reorder_window
+       (in units of the CAEN clock) older than the latest time stamp
+       read so far are kept aside and sorted together with the following
+       chunk. Events coming later than this are reported and yielded
+       anyway with the next chunk.
+
+       Arguments
+       ---------
+       file_path : str
+           path and name of the file to process
+       num_of_channels : list of int
+           the channels to select (0, 1, 2, or 3)
+       chunk_size : int
+           number of events read at a time
+       reorder_window : int
+           maximum delay (in units of the CAEN clock) of an event with
+           respect to the time order
+       selection : numpy array
+           if not None, keep only the events passing this selection table
+           (see make_selection)
+    """
+    logger.info('Streaming data file %s...' % file_path)
+    events = np.empty(0, dtype=EVENT_DTYPE)
+    t_last = None
+    for chunk in iter_events(file_path, chunk_size, selection=selection):
+        events = np.concatenate((events, chunk))
+        if not _is_sorted(events['t']):
+            events = events[np.argsort(events['t'], kind='mergesort')]
+        if t_last is not None and events['t'][0] < t_last:
+            logger.warning('%i events beyond the reorder window' %\
+                           np.count_nonzero(events['t'] < t_last))
+        _num = np.searchsorted(events['t'], events['t'][-1] - reorder_window)
+        if _num == 0:
+            continue
+        t_last = events['t'][_num - 1]
+        yield demux_events(events[:_num], num_of_channels)
+        events = events[_num:]
+    if len(events) > 0:
+        yield demux_events(events, num_of_channels)
 
 def main():
     """Simple function test
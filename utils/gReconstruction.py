@@ -0,0 +1,177 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Iterative (MLEM/OSEM) reconstruction of the images of the box.
+
+   The lines of response of the scans (as built by gBox.mkline) and their
+   numbers of coincidences are the measurements; the system matrix, with
+   one row per line and one column per pixel of the image, holds the
+   exact length of each line inside each pixel, and is stored as a sparse
+   (CSR) matrix, so that the forward and back projections are two sparse
+   matrix-vector products. Since it only depends on the geometry of the
+   scans, it is also stored on disk and computed only once.
+"""
+
+import os
+import time
+import numpy as np
+from scipy import sparse
+
+from advlab import ADVLAB_OUT
+from advlab.utils.logging_ import logger
+from advlab.utils.gHistogram import gHistogram, save_histograms
+from advlab.utils.gBox import image_binning, lines_pixels
+from advlab.utils.gCache import cached_arrays
+
+
+def system_matrix(lines_list, binning):
+    """Return the system matrix (lines x pixels, CSR) of a set of lines,
+       i.e. the length of each line in each pixel (see gBox.lines_pixels),
+       with the pixels of the image flattened in C order (x major).
+    """
+    (nx, xmin, xmax), (ny, ymin, ymax) = binning
+    rows, pixels, lengths = lines_pixels(lines_list, binning)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, \
+                                            minlength=len(lines_list)))])
+    return sparse.csr_matrix((lengths, pixels, indptr), \
+                             shape=(len(lines_list), nx*ny))
+
+def cached_system_matrix(lines_list, binning, use_cache=True):
+    """Return the system matrix of a set of lines, stored on disk (see
+       gCache.cached_arrays) and keyed by the geometry, i.e. the binning
+       of the image and the end points of the lines (rounded to 1 nm), so
+       that it is computed only once for each scan geometry.
+    """
+    def _compute():
+        matrix = system_matrix(lines_list, binning)
+        return {'data': matrix.data, 'indices': matrix.indices,
+                'indptr': matrix.indptr}
+    if not use_cache:
+        return system_matrix(lines_list, binning)
+    params = {'binning': [list(b) for b in binning],
+              'lines': np.round(np.array(lines_list, dtype=np.float64)\
+                                .reshape((len(lines_list), 4)), 6).tolist()}
+    arrays = cached_arrays('system_matrix', params, _compute)
+    return sparse.csr_matrix((arrays['data'], arrays['indices'], \
+                              arrays['indptr']), \
+                             shape=(len(lines_list), \
+                                    binning[0][0]*binning[1][0]))
+
+def mlem(matrix, counts, num_iter=20, subsets=1, tolerance=1e-6):
+    """Maximum likelihood expectation maximization of the image, with
+       optional ordered subsets (OSEM).
+
+       The lines are split in subsets by interleaving (line i goes to the
+       subset i % subsets), and each iteration makes one update of the
+       image per subset; the pixels not seen by the lines of a subset are
+       left unchanged by its update. There cannot be more subsets than
+       lines (the number of subsets is reduced to the number of lines).
+       The iterations stop after num_iter, or earlier when the relative
+       change of the image is below tolerance.
+
+       Returns the image (flat, as the columns of the matrix) and the
+       time spent in each iteration.
+
+       Arguments
+       ---------
+       matrix : scipy sparse matrix
+           the system matrix (lines x pixels)
+       counts : array
+           number of coincidences of each line
+       num_iter : int
+           maximum number of iterations
+       subsets : int
+           number of ordered subsets (1 for MLEM)
+       tolerance : float
+           relative change of the image at convergence
+    """
+    if subsets < 1:
+        raise ValueError('Invalid number of subsets (%i)' % subsets)
+    if subsets > matrix.shape[0]:
+        logger.warning('%i subsets for %i lines, using %i subsets' %\
+                       (subsets, matrix.shape[0], matrix.shape[0]))
+        subsets = max(matrix.shape[0], 1)
+    counts = np.asarray(counts, dtype=np.float64)
+    rows = [np.arange(i, matrix.shape[0], subsets) for i in range(subsets)]
+    blocks = [(matrix[r], matrix[r].T.tocsr(), counts[r]) for r in rows]
+    # Sensitivity of each pixel, for each subset.
+    sens = [np.asarray(a.sum(axis=0)).ravel() for a, at, y in blocks]
+    image = np.ones(matrix.shape[1])
+    image[np.asarray(matrix.sum(axis=0)).ravel() == 0] = 0
+    times = []
+    for i in range(num_iter):
+        start = time.time()
+        old = image.copy()
+        for (a, at, y), s in zip(blocks, sens):
+            proj = a.dot(image)
+            ratio = np.divide(y, proj, out=np.zeros_like(y), where=proj > 0)
+            image *= np.divide(at.dot(ratio), s, out=np.ones_like(s), \
+                               where=s > 0)
+        times.append(time.time() - start)
+        change = np.abs(image - old).sum()/max(old.sum(), 1e-300)
+        logger.info('Iteration %i: %.4f s, relative change %.2e' %\
+                    (i + 1, times[-1], change))
+        if change < tolerance:
+            logger.info('Converged after %i iterations' % (i + 1))
+            break
+    logger.info('Total time of the iterations: %.3f s' % sum(times))
+    return image, times
+
+def reconstruct(lines_list, rate_list, x_side, y_side, gran=1, num_iter=20, \
+                subsets=1, outfile='imaging.root', use_cache=True):
+    """Iterative reconstruction of the image of the box, with the same
+       inputs and binning as gBox.imaging (the system matrix is cached,
+       see cached_system_matrix).
+
+       The image is written in outfile, as a ROOT file or in the format
+       given by its extension (see gHistogram.save_histograms).
+    """
+    binning = image_binning(x_side, y_side, gran)
+    start = time.time()
+    matrix = cached_system_matrix(lines_list, binning, use_cache)
+    logger.info('System matrix: %i lines x %i pixels, %i non-zero (%.3f s)' %\
+                (matrix.shape[0], matrix.shape[1], matrix.nnz, \
+                 time.time() - start))
+    image, times = mlem(matrix, rate_list, num_iter, subsets)
+    hh = gHistogram('pet', 'Sources imaging (%s)' % \
+                    ('MLEM' if subsets == 1 else 'OSEM %i' % subsets), \
+                    binning, ['x [mm]', 'y [mm]'])
+    hh.content[1:-1, 1:-1] = image.reshape((binning[0][0], binning[1][0]))
+    save_histograms(os.path.join(ADVLAB_OUT,outfile), [hh])
+    logger.info('Created %s'%os.path.join(ADVLAB_OUT,outfile))
+    return hh
+
+
+def main():
+    """Simple test code.
+    """
+    from advlab.utils.gBox import mkline
+    # Two point sources, seen by lines at 0, 40 and 80 degrees.
+    sources = [(-10., 5.), (15., -8.)]
+    lines_list, rate_list = [], []
+    for th in (0, 40, 80):
+        for y in np.arange(-30, 31, 2.5):
+            line = mkline(y, th)
+            (x1, y1), (x2, y2) = line
+            dist = [abs((y2 - y1)*sx - (x2 - x1)*sy + x2*y1 - y2*x1)/\
+                    np.hypot(x2 - x1, y2 - y1) for sx, sy in sources]
+            lines_list.append(line)
+            rate_list.append(sum(100*np.exp(-0.5*(d/2.)**2) for d in dist))
+    binning = image_binning(80, 55)
+    image, times = mlem(system_matrix(lines_list, binning), rate_list, 50, 3)
+    image = image.reshape((binning[0][0], binning[1][0]))
+    ix, iy = np.unravel_index(np.argmax(image), image.shape)
+    logger.info('Maximum of the image in bin (%i, %i)' % (ix, iy))
+
+
+if __name__ == '__main__':
+    main()